@@ -17,7 +17,17 @@ import matplotlib.pyplot as plt
 import time
 import os
 import math
-from PIL import Image
+import random
+import copy
+import collections
+import itertools
+import io
+import struct
+import tarfile
+import zipfile
+import zlib
+from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from google.colab import files
 from tqdm import tqdm
 import statistics
@@ -40,7 +50,8 @@ import torchtext
 import torchvision
 import torch.nn.functional as f
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
 
 # seed for results replication
 seed = 211
@@ -53,10 +64,19 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 ### *Hyperparameters Class*
 
 Makes keeping track of hyperparameters easier
+
+*   `output_head` - `'full'` for a full softmax over the vocabulary, `'adaptive'` for `AdaptiveHead`.
+*   `cutoffs` - Frequency rank cutoffs of the adaptive softmax clusters (`None` for the default).
+*   `loss_chunk_size` - If set then the full softmax loss is computed `loss_chunk_size` time steps at a time and the logits are recomputed in the backward pass, so peak memory does not grow with `vocab_size * seq_len`.
 """
 
 class Hyperparameters:
-    def __init__(self, embed_size, vocab_size, learning_rate, num_epochs, num_layers=1, hidden_size=256, attention_dim=256, encoder_dim=2048, decoder_dim=512):
+    # defaults for checkpoints pickled before these options existed
+    output_head = 'full'
+    cutoffs = None
+    loss_chunk_size = None
+
+    def __init__(self, embed_size, vocab_size, learning_rate, num_epochs, num_layers=1, hidden_size=256, attention_dim=256, encoder_dim=2048, decoder_dim=512, output_head='full', cutoffs=None, loss_chunk_size=None):
         self.embed_size = embed_size
         self.hidden_size = hidden_size
         self.vocab_size = vocab_size
@@ -66,6 +86,149 @@ class Hyperparameters:
         self.attention_dim = attention_dim
         self.encoder_dim = encoder_dim
         self.decoder_dim = decoder_dim
+        self.output_head = output_head
+        self.cutoffs = cutoffs
+        self.loss_chunk_size = loss_chunk_size
+
+"""### *Adaptive softmax output head*
+Drop-in replacement for the decoders' vocabulary projection. Words are reordered by their training frequency so the most frequent ones share a small head softmax and the rare ones go to cheaper tail clusters.
+*   `forward` - Full log-probabilities in vocabulary order (same shape as the `nn.Linear` logits).
+*   `predict` - Greedy word ids; only evaluates a tail cluster when the head picks it.
+*   `loss` - Mean negative log-likelihood over the non-padding targets.
+"""
+
+class AdaptiveHead(nn.Module):
+    def __init__(self, in_features, vocab_size, token_counts, cutoffs=None, div_value=4.0):
+        super(AdaptiveHead, self).__init__()
+        if cutoffs is None:
+            cutoffs = [c for c in (256, 1024) if c < vocab_size - 1] or [max(1, vocab_size // 4)]
+        counts = torch.tensor(token_counts, dtype=torch.float)
+        order = counts.argsort(descending=True)                     # frequency rank -> word id
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(vocab_size)                      # word id -> frequency rank
+        self.register_buffer("order", order)
+        self.register_buffer("rank", rank)
+        self.softmax = nn.AdaptiveLogSoftmaxWithLoss(in_features, vocab_size, list(cutoffs), div_value=div_value)
+
+    def forward(self, x):
+        log_probs = self.softmax.log_prob(x.reshape(-1, x.size(-1)))[:, self.rank]
+        return log_probs.view(*x.shape[:-1], -1)
+
+    def predict(self, x):
+        return self.order[self.softmax.predict(x)]
+
+    def loss(self, x, targets, ignore_index):
+        x = x.reshape(-1, x.size(-1))
+        targets = targets.reshape(-1)
+        keep = targets != ignore_index
+        return self.softmax(x[keep], self.rank[targets[keep]]).loss
+
+"""### *Caption loss*
+Training loss of a batch for either model and output head.
+*   `captions` - `(seq_len, batch_size)` as returned by the loaders.
+*   `attention` - `True` for Model 2, `False` for Model 1.
+*   `chunk_size` - If set then uses `chunked_cross_entropy` for the full softmax.
+"""
+
+def projected_cross_entropy(hiddens, targets, projection, ignore_index):
+    logits = projection(hiddens)
+    return f.cross_entropy(logits.reshape(-1, logits.size(-1)), targets.reshape(-1), ignore_index=ignore_index, reduction="sum")
+
+def chunked_cross_entropy(hiddens, targets, projection, ignore_index, chunk_size, time_dim=0):
+    # only one chunk of logits exists at a time, checkpoint recomputes it in backward
+    total = 0
+    for h, t in zip(hiddens.split(chunk_size, dim=time_dim), targets.split(chunk_size, dim=time_dim)):
+        total = total + checkpoint(projected_cross_entropy, h, t, projection, ignore_index, use_reentrant=False)
+    return total / (targets != ignore_index).sum().clamp(min=1)
+
+def caption_loss(model, imgs, captions, criterion, attention=False, cached=False, chunk_size=None):
+    if attention:
+        captions = captions.permute(1,0)
+        targets = captions[:,1:]
+        head = model.decoder.fcn
+        if isinstance(head, AdaptiveHead):
+            hiddens, _ = model(imgs, captions, cached=cached, return_hidden=True)
+            return head.loss(hiddens, targets, criterion.ignore_index)
+        if chunk_size is not None:
+            hiddens, _ = model(imgs, captions, cached=cached, return_hidden=True)
+            return chunked_cross_entropy(hiddens, targets, head, criterion.ignore_index, chunk_size, time_dim=1)
+        outputs, _ = model(imgs, captions, cached=cached)
+        return criterion(outputs.reshape(-1, outputs.shape[2]), targets.reshape(-1))
+
+    head = model.decoderRNN.linear
+    if isinstance(head, AdaptiveHead):
+        hiddens = model(imgs, captions[:-1], cached=cached, return_hidden=True)
+        return head.loss(hiddens, captions, criterion.ignore_index)
+    if chunk_size is not None:
+        hiddens = model(imgs, captions[:-1], cached=cached, return_hidden=True)
+        return chunked_cross_entropy(hiddens, captions, head, criterion.ignore_index, chunk_size, time_dim=0)
+    outputs = model(imgs, captions[:-1], cached=cached)
+    return criterion(outputs.reshape(-1, outputs.shape[2]), captions.reshape(-1))
+
+"""### *Caption scoring*
+Helpers of `score_captions`, which both models use to score candidate captions for an image.
+*   `candidates` - For every image a list of captions, each a string, a list of words or a list of token ids (with `<sos>` and `<eos>`).
+"""
+
+def pad_candidates(candidates, vocabulary):
+    specials = {"<sos>", "<eos>", "<pad>"}
+    sequences, owners = [], []
+    for owner, image_candidates in enumerate(candidates):
+        for candidate in image_candidates:
+            if isinstance(candidate, str):
+                ids = vocabulary.numericalize(candidate)
+            elif len(candidate) > 0 and isinstance(candidate[0], str):
+                ids = [vocabulary.stoi.get(word, vocabulary.stoi["<unk>"]) for word in candidate if word not in specials]
+            else:
+                sequences.append(torch.as_tensor(candidate, dtype=torch.long))
+                owners.append(owner)
+                continue
+            sequences.append(torch.tensor([vocabulary.stoi["<sos>"]] + ids + [vocabulary.stoi["<eos>"]]))
+            owners.append(owner)
+    tokens = pad_sequence(sequences, batch_first=True, padding_value=vocabulary.stoi["<pad>"])
+    return tokens, torch.tensor(owners)                  #(num_candidates,seq_len), (num_candidates)
+
+def sequence_log_likelihood(log_probs, targets, pad_idx, length_norm=True):
+    # log_probs (num_candidates,seq_len,vocab_size) predicting targets (num_candidates,seq_len)
+    token_scores = log_probs.gather(2, targets.unsqueeze(2)).squeeze(2)
+    mask = targets != pad_idx
+    totals = (token_scores * mask).sum(dim=1)
+    if length_norm:
+        return totals / mask.sum(dim=1).clamp(min=1)
+    return totals
+
+def split_scores(scores, owners, num_images):
+    return [scores[owners == i] for i in range(num_images)]
+
+"""### *Benchmark train step time*
+Average seconds per optimizer step over `num_steps` batches (after `warmup` steps), used to compare model variants.
+"""
+
+def benchmark_train_step(model, loader, criterion, device, attention=False, cached=False, num_steps=50, warmup=5, chunk_size=None):
+    # steps run on a copy so the benchmarked model keeps its weights
+    model = copy.deepcopy(model)
+    optimizer = optim.Adam(model.parameters(), lr=3e-4)
+    model.train()
+    times = []
+
+    for idx, (imgs, captions, _) in enumerate(loader):
+        if idx == num_steps + warmup:
+            break
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+
+        loss = caption_loss(model, imgs.to(device), captions.to(device), criterion, attention=attention, cached=cached, chunk_size=chunk_size)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if idx >= warmup:
+            times.append(time.time() - start)
+
+    return statistics.mean(times)
 
 """### *Convert Image to plot*"""
 
@@ -91,7 +254,8 @@ def plot_attention(img, result, attention_plot, idx, save=False, dpi=None):
         ax = fig.add_subplot(len_result//2,len_result//2, l+1)
         ax.set_title(result[l+1])
         a = ax.imshow(img)
-        temp_att = attention_plot[l].reshape(7,7)
+        grid = attention_grid_size(attention_plot[l].size)
+        temp_att = attention_plot[l].reshape(grid,grid)
         ax.imshow(temp_att, cmap='gray', alpha=0.5, extent=a.get_extent())
         ax.set_xticks([])
         ax.set_yticks([])
@@ -104,14 +268,118 @@ def plot_attention(img, result, attention_plot, idx, save=False, dpi=None):
       #files.download(filename+".png") 
     plt.show()
 
+"""### *Render attention overlays without a display*
+Headless alternative to `plot_attention` for batch jobs: the alpha maps are upsampled to image resolution with NumPy, blended into the image array and written as a PNG grid, one process per image.
+*   `attention_grid_size` - Side of the encoder feature map, inferred from the number of attention weights.
+*   `render_attention_batch` - Renders `(img, result, attention_plot, filename)` jobs in a process pool.
+*   `render_attention_dataset` - Captions the images of a loader and renders one overlay per unique image to `out_dir`, returns unique images/sec.
+"""
+
+def attention_grid_size(num_features):
+    grid = int(round(math.sqrt(num_features)))
+    if grid * grid != num_features:
+        raise ValueError(f"Cannot infer a square feature map from {num_features} attention weights")
+    return grid
+
+def upsample_alphas(alphas, height, width):
+    # bilinear upsampling of (num_words, grid*grid) weights to (num_words, height, width)
+    grid = attention_grid_size(alphas.shape[1])
+    alphas = alphas.reshape(-1, grid, grid).astype(np.float32)
+
+    ys = np.clip((np.arange(height) + 0.5) * grid / height - 0.5, 0, grid - 1)
+    xs = np.clip((np.arange(width) + 0.5) * grid / width - 0.5, 0, grid - 1)
+    y0, x0 = ys.astype(int), xs.astype(int)
+    y1, x1 = np.minimum(y0 + 1, grid - 1), np.minimum(x0 + 1, grid - 1)
+    wy, wx = (ys - y0)[:, None], (xs - x0)[None, :]
+
+    top = alphas[:, y0[:, None], x0[None, :]] * (1 - wx) + alphas[:, y0[:, None], x1[None, :]] * wx
+    bottom = alphas[:, y1[:, None], x0[None, :]] * (1 - wx) + alphas[:, y1[:, None], x1[None, :]] * wx
+    return top * (1 - wy) + bottom * wy
+
+def composite_attention(img, alphas):
+    # same look as plot_attention: gray attention map at alpha 0.5, scaled per word
+    img = np.asarray(img, dtype=np.float32)
+    maps = upsample_alphas(alphas, img.shape[0], img.shape[1])
+    low = maps.min(axis=(1, 2), keepdims=True)
+    high = maps.max(axis=(1, 2), keepdims=True)
+    maps = (maps - low) / np.maximum(high - low, 1e-8)
+    blended = 0.5 * img[None] + 127.5 * maps[..., None]
+    return blended.astype(np.uint8)                      #(num_words,height,width,3)
+
+def render_attention_grid(img, result, attention_plot, filename, title_height=16):
+    alphas = np.concatenate([np.asarray(a).reshape(1, -1) for a in attention_plot])
+    frames = composite_attention(img, alphas)
+    num_words, height, width, _ = frames.shape
+    cols = int(math.ceil(math.sqrt(num_words)))
+    rows = int(math.ceil(num_words / cols))
+
+    canvas = np.full((rows * (height + title_height), cols * width, 3), 255, dtype=np.uint8)
+    for l in range(num_words):
+        top = (l // cols) * (height + title_height) + title_height
+        left = (l % cols) * width
+        canvas[top:top + height, left:left + width] = frames[l]
+
+    grid_img = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(grid_img)
+    font = ImageFont.load_default()
+    for l in range(num_words):
+        draw.text(((l % cols) * width + 2, (l // cols) * (height + title_height) + 2), result[l+1], fill=(0, 0, 0), font=font)
+    grid_img.save(filename)
+    return filename
+
+def render_attention_job(job):
+    return render_attention_grid(*job)
+
+def render_attention_batch(jobs, num_workers=4, chunksize=4):
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(render_attention_job, jobs, chunksize=chunksize))
+
+def denormalize_images(imgs, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    mean = torch.tensor(mean, device=imgs.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=imgs.device).view(1, -1, 1, 1)
+    imgs = ((imgs * std + mean).clamp(0, 1) * 255).round().to(torch.uint8)
+    return imgs.permute(0, 2, 3, 1).cpu().numpy()        #(batch_size,height,width,3)
+
+def render_attention_dataset(model, loader, dataset, device, out_dir, num_batches=None, num_workers=4, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    model.eval()
+    os.makedirs(out_dir, exist_ok=True)
+    futures = []
+    rendered = set()
+    start = time.time()
+
+    # captions are decoded here while the pool renders the previous ones
+    with ProcessPoolExecutor(max_workers=num_workers) as pool, torch.no_grad():
+        for i, (imgs, _, ids) in tqdm(
+            enumerate(loader), total=len(loader), leave=True, position=0
+        ):
+            if num_batches == i:
+              break
+            arrays = denormalize_images(imgs, mean, std)
+            for j, img in enumerate(imgs):
+              # the loader yields every image once per caption, render it only once
+              if ids[j] in rendered:
+                continue
+              rendered.add(ids[j])
+              caption, alphas = model.caption_image(img.unsqueeze(0).to(device), dataset.vocab)
+              filename = os.path.join(out_dir, "attention_%s.png" % os.path.splitext(ids[j])[0])
+              futures.append(pool.submit(render_attention_grid, arrays[j], caption, alphas, filename))
+        for future in futures:
+            future.result()
+
+    images_per_sec = len(futures) / (time.time() - start)
+    print(f"Rendered {len(futures)} unique images - {images_per_sec:.1f} images/sec")
+    model.train()
+    return images_per_sec
+
 """### *Display images with model prediction caption*
 *   `path` - Path for folder where images are.
 *   `attention` - if the model uses Attention set to `True`.
 *   `max_imgs` - Select amount of random images from the folder to be displayed.
+*   `render_dir` - If set (with `attention=True`) then writes the attention overlays to this folder with `render_attention_batch` instead of plotting them.
 
 """
 
-def print_examples(model, device, dataset, path, transform, attention=False, save=False, max_imgs=5, dpi=None):
+def print_examples(model, device, dataset, path, transform, attention=False, save=False, max_imgs=5, dpi=None, render_dir=None, num_workers=4):
     model.eval()  
     img_files = np.array(os.listdir(path))
     
@@ -141,7 +409,16 @@ def print_examples(model, device, dataset, path, transform, attention=False, sav
         axes[idx].set_yticks([])
     if save:
       plt.savefig("examples.png", dpi=dpi)    
-    if attention:
+    if attention and render_dir is not None:
+      os.makedirs(render_dir, exist_ok=True)
+      jobs = []
+      for idx, image_path in enumerate(images):
+        input_path = os.path.join(path, image_path)
+        test_img = Image.open(input_path).convert("RGB")
+        caption, alphas = model.caption_image(transform(test_img).unsqueeze(0).to(device), dataset.vocab)
+        jobs.append((np.asarray(test_img), caption, alphas, os.path.join(render_dir, "attention%d.png" % (idx))))
+      render_attention_batch(jobs, num_workers=num_workers)
+    elif attention:
       for idx, image_path in enumerate(images): 
         input_path = os.path.join(path, image_path)
         test_img = Image.open(input_path).convert("RGB")
@@ -154,7 +431,9 @@ def print_examples(model, device, dataset, path, transform, attention=False, sav
 
 def save_checkpoint(state, filename="my_checkpoint.pth"):
     print("=> Saving checkpoint")
-    torch.save(state, filename)
+    # write to a temporary file first so a preempted save never corrupts the last checkpoint
+    torch.save(state, filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
 
 
 def load_checkpoint(checkpoint_path, model, optimizer, device):
@@ -168,6 +447,50 @@ def load_hyperparams(checkpoint_path, device):
     state = torch.load(checkpoint_path, map_location=device)
     return state["hyperparams"]
 
+"""### *Resumable training state*
+*   `epoch` - Last fully completed epoch.
+*   `resume` - Position inside the running epoch (`None` when saved at the end of an epoch).
+*   `load_resume_state` - Restores the RNG states and returns the saved position inside the epoch.
+"""
+
+def get_rng_state():
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+
+def set_rng_state(rng):
+    torch.set_rng_state(rng["torch"].cpu())
+    if rng["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng["cuda"]])
+    np.random.set_state(rng["numpy"])
+    random.setstate(rng["python"])
+
+def training_state(model, optimizer, epoch, losses, hyper, resume=None):
+    return {
+        "state_dict": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "epoch": epoch,
+        "losses": losses,
+        "hyperparams": hyper,
+        "rng": get_rng_state(),
+        "resume": resume
+    }
+
+def load_resume_state(checkpoint_path, device):
+    state = torch.load(checkpoint_path, map_location=device)
+    # checkpoints saved before step-level checkpointing have neither key
+    if state.get("rng") is not None:
+        set_rng_state(state["rng"])
+    return state.get("resume")
+
+def checkpoint_due(step, last_save, checkpoint_steps=None, checkpoint_secs=None):
+    if checkpoint_steps is not None and step % checkpoint_steps == 0:
+        return True
+    return checkpoint_secs is not None and time.time() - last_save >= checkpoint_secs
+
 """### *Evaluate BLEU score*
 *   `loader` - Loader for the data to evaluate from.
 *   `model` - Model evaluated.
@@ -259,6 +582,8 @@ class Vocabulary:
     def build_vocabulary(self, sentence_list):
         frequencies = {}
         idx = 4
+        self.frequencies = frequencies
+        self.num_sentences = len(sentence_list)
 
         for sentence in sentence_list:
             for word in self.tokenizer_eng(sentence):
@@ -273,6 +598,15 @@ class Vocabulary:
                     self.itos[idx] = word
                     idx += 1
 
+    def token_counts(self):
+        # training counts per word id, used to order the adaptive softmax
+        counts = [0] * len(self.itos)
+        for word, freq in self.frequencies.items():
+            counts[self.stoi.get(word, self.stoi["<unk>"])] += freq
+        counts[self.stoi["<sos>"]] = self.num_sentences
+        counts[self.stoi["<eos>"]] = self.num_sentences
+        return counts
+
     def numericalize(self, text):
         tokenized_text = self.tokenizer_eng(text)
 
@@ -284,8 +618,9 @@ class Vocabulary:
 """## *Flickr8kDataset Class*"""
 
 class Flickr8kDataset(Dataset):
-    def __init__(self, root_dir, captions_file, transform=None, freq_threshold=5, split='', test_size=0.1):
+    def __init__(self, root_dir, captions_file, transform=None, freq_threshold=5, split='', test_size=0.1, image_reader=None):
         self.root_dir = root_dir
+        self.image_reader = image_reader
         self.df = pd.read_csv(captions_file)
         self.transform = transform
         # Get img, caption columns
@@ -321,27 +656,259 @@ class Flickr8kDataset(Dataset):
     def __len__(self):
         return len(self.captions)
 
+    def load_image(self, img_id):
+        if self.image_reader is not None:
+            return self.image_reader.open(img_id)
+        return Image.open(os.path.join(self.root_dir, img_id)).convert("RGB")
+
+    def caption_tensor(self, index):
+        numericalized_caption = [self.vocab.stoi["<sos>"]]
+        numericalized_caption += self.vocab.numericalize(self.captions[index])
+        numericalized_caption.append(self.vocab.stoi["<eos>"])
+        return torch.tensor(numericalized_caption)
+
     def __getitem__(self, index):
-        caption = self.captions[index]
         img_id = self.imgs[index]
-        img = Image.open(os.path.join(self.root_dir, img_id)).convert("RGB")
+        img = self.load_image(img_id)
 
         if self.transform is not None:
             img = self.transform(img)
 
-        numericalized_caption = [self.vocab.stoi["<sos>"]]
-        numericalized_caption += self.vocab.numericalize(caption)
-        numericalized_caption.append(self.vocab.stoi["<eos>"])
+        return img, self.caption_tensor(index), img_id
+
+"""## *Archive Image Readers*
+Read the images straight from `flickr8k.zip` or from tar shards instead of thousands of small files.
+The member index is built once in the main process; every DataLoader worker then opens its own file handle and reads members with a single seek.
+
+*   `ZipImageReader` - Reads members of the downloaded zip (`prefix` is the images folder inside the archive).
+*   `TarShardReader` - Random access into tar shards written by `repack_tar_shards`.
+*   `open_archive` - `ZipImageReader` for a `.zip` file, `TarShardReader` for a shards directory.
+"""
+
+class ArchiveReader:
+    def __init__(self):
+        self.handles = {}
+        self.pid = None
+
+    def __getstate__(self):
+        # file handles are per process, workers reopen them on first read
+        state = self.__dict__.copy()
+        state["handles"] = {}
+        state["pid"] = None
+        return state
+
+    def handle(self, path):
+        if self.pid != os.getpid():
+            self.handles = {}
+            self.pid = os.getpid()
+        if path not in self.handles:
+            self.handles[path] = open(path, "rb")
+        return self.handles[path]
+
+    def open(self, img_id):
+        return Image.open(io.BytesIO(self.read(img_id))).convert("RGB")
+
+
+class ZipImageReader(ArchiveReader):
+    def __init__(self, zip_path, prefix="Images/"):
+        super().__init__()
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path) as archive:
+            self.index = {
+                info.filename[len(prefix):]: (info.header_offset, info.compress_size, info.compress_type)
+                for info in archive.infolist()
+                if info.filename.startswith(prefix) and not info.is_dir()
+            }
+
+    def read(self, img_id):
+        header_offset, compress_size, compress_type = self.index[img_id]
+        file = self.handle(self.zip_path)
+        file.seek(header_offset)
+        header = file.read(30)
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        file.seek(header_offset + 30 + name_len + extra_len)
+        data = file.read(compress_size)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"Unsupported zip compression for {img_id}")
+        return data
+
+
+class TarShardReader(ArchiveReader):
+    def __init__(self, shard_dir):
+        super().__init__()
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "index.json")) as file:
+            index = json.load(file)
+        self.shards = index["shards"]
+        self.index = {img_id: tuple(entry) for img_id, entry in index["members"].items()}
+
+    def read(self, img_id):
+        shard, offset, size = self.index[img_id]
+        file = self.handle(os.path.join(self.shard_dir, self.shards[shard]))
+        file.seek(offset)
+        return file.read(size)
+
+
+def repack_tar_shards(reader, img_ids, shard_dir, shard_size=1000):
+    # uncompressed tar shards, so a sequential read of a shard returns whole images
+    os.makedirs(shard_dir, exist_ok=True)
+    img_ids = list(dict.fromkeys(img_ids))
+    shards, members = [], {}
+
+    for start in tqdm(range(0, len(img_ids), shard_size), leave=True, position=0):
+        name = "shard-%05d.tar" % len(shards)
+        with tarfile.open(os.path.join(shard_dir, name), "w") as shard:
+            for img_id in img_ids[start:start + shard_size]:
+                data = reader.read(img_id)
+                info = tarfile.TarInfo(img_id)
+                info.size = len(data)
+                shard.addfile(info, io.BytesIO(data))
+        with tarfile.open(os.path.join(shard_dir, name), "r") as shard:
+            for info in shard.getmembers():
+                members[info.name] = (len(shards), info.offset_data, info.size)
+        shards.append(name)
+
+    with open(os.path.join(shard_dir, "index.json"), "w") as file:
+        json.dump({"shards": shards, "members": members}, file)
+    return TarShardReader(shard_dir)
+
+
+def open_archive(archive):
+    if archive.endswith(".zip"):
+        return ZipImageReader(archive)
+    return TarShardReader(archive)
+
+"""## *Streaming Shard Dataset*
+Sequential alternative to random access: each worker streams whole tar shards, so an epoch is a few large sequential reads.
+Shard order is shuffled per epoch and samples are shuffled inside a `shuffle_buffer`; every image is decoded once for all its captions.
+
+*   `dataset` - `Flickr8kDataset` that provides the captions and vocabulary.
+*   `shard_dir` - Directory written by `repack_tar_shards`.
+*   `ShardStreamLoader` - Every worker ends its shards with its own partial batch, so `len(loader)` sums the batches of each worker (for the current epoch's shard order).
+"""
+
+class Flickr8kShardStream(IterableDataset):
+    def __init__(self, dataset, shard_dir, transform=None, shuffle_buffer=256, seed=seed):
+        self.dataset = dataset
+        self.vocab = dataset.vocab
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        with open(os.path.join(shard_dir, "index.json")) as file:
+            index_file = json.load(file)
+        self.shards = index_file["shards"]
+        self.caption_indices = {}
+        for index, img_id in enumerate(dataset.imgs):
+            self.caption_indices.setdefault(img_id, []).append(index)
+        # samples (captions) per shard
+        self.shard_sizes = {name: 0 for name in self.shards}
+        for img_id, (shard, _, _) in index_file["members"].items():
+            self.shard_sizes[self.shards[shard]] += len(self.caption_indices.get(img_id, []))
 
-        return img, torch.tensor(numericalized_caption), img_id
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def worker_shards(self, worker_id=0, num_workers=1):
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[worker_id::num_workers]
+
+    def num_batches(self, batch_size, num_workers):
+        num_workers = max(1, num_workers)
+        return sum(math.ceil(sum(self.shard_sizes[name] for name in self.worker_shards(w, num_workers)) / batch_size) for w in range(num_workers))
+
+    def samples(self, shards):
+        for name in shards:
+            with tarfile.open(os.path.join(self.shard_dir, name), "r|") as shard:
+                for info in shard:
+                    if info.name not in self.caption_indices:
+                        continue
+                    img = Image.open(io.BytesIO(shard.extractfile(info).read())).convert("RGB")
+                    for index in self.caption_indices[info.name]:
+                        sample = self.transform(img) if self.transform is not None else img
+                        yield sample, self.dataset.caption_tensor(index), info.name
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is not None:
+            shards = self.worker_shards(worker.id, worker.num_workers)
+            rng = random.Random(self.seed + self.epoch * 1000 + worker.id)
+        else:
+            shards = self.worker_shards()
+            rng = random.Random(self.seed + self.epoch)
+
+        buffer = []
+        for sample in self.samples(shards):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            buffer[idx], sample = sample, buffer[idx]
+            yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class ShardStreamLoader(DataLoader):
+    def __len__(self):
+        return self.dataset.num_batches(self.batch_size, self.num_workers)
+
+
+def get_stream_loader(dataset, shard_dir, transform, batch_size=32, num_workers=2, pin_memory=True, shuffle_buffer=256):
+    stream = Flickr8kShardStream(dataset, shard_dir, transform=transform, shuffle_buffer=shuffle_buffer)
+
+    loader = ShardStreamLoader(
+        dataset=stream,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=MyCollate(pad_idx=dataset.vocab.stoi["<pad>"]),
+    )
+
+    return loader, stream
 
 """## *Loader Creator*
 
 *   `root_folder` - Directory for the images in dataset.
 *   `annotation_file` - File from dataset that contains the captions.
 *   `split` - `'train'` for train set, `'test'` for test set, otherwise returns full dataset loader.
+*   `resumable` - If `True` then shuffles with a `ResumableRandomSampler` so training can resume mid-epoch.
+*   `archive` - If set then reads the images from this zip file or tar shards directory instead of `root_folder`.
+*   `persistent_workers` - If `True` then keeps the worker processes alive between epochs.
+*   `prefetch_factor` - Batches loaded in advance by each worker.
+*   `image_reader` - Already opened `open_archive` reader, takes the place of `archive` so several loaders share one index.
 """
 
+class ResumableRandomSampler(Sampler):
+    # Shuffles with a generator seeded by (seed + epoch), so the order of any epoch can be
+    # replayed and iteration can start directly at the first sample not yet consumed.
+    def __init__(self, data_source, seed=seed):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_position(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator)[self.start:].tolist()
+        return iter(order)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
 class MyCollate:
     def __init__(self, pad_idx):
         self.pad_idx = pad_idx
@@ -364,23 +931,150 @@ def get_loader(
     shuffle=True,
     pin_memory=True,
     split='',
-    test_size=0.1):
+    test_size=0.1,
+    resumable=False,
+    archive=None,
+    persistent_workers=False,
+    prefetch_factor=2,
+    image_reader=None):
   
-    dataset = Flickr8kDataset(root_folder, annotation_file, transform=transform, split=split, test_size=test_size)
+    # an already opened reader (image_reader) shares one central directory index between loaders
+    if image_reader is None and archive is not None:
+        image_reader = open_archive(archive)
+    dataset = Flickr8kDataset(root_folder, annotation_file, transform=transform, split=split, test_size=test_size, image_reader=image_reader)
 
     pad_idx = dataset.vocab.stoi["<pad>"]
 
+    sampler = ResumableRandomSampler(dataset) if resumable else None
+
+    # DataLoader only accepts these options when it uses worker processes
+    worker_args = {"persistent_workers": persistent_workers, "prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+
     loader = DataLoader(
         dataset=dataset,
         batch_size=batch_size,
         num_workers=num_workers,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         pin_memory=pin_memory,
         collate_fn=MyCollate(pad_idx=pad_idx),
+        **worker_args,
     )
 
     return loader, dataset
 
+"""## *Cached Encoder Activations*
+
+Runs a frozen encoder prefix once per image and stores its activations as a float16 `.npy` memmap, so training only pays for the layers being fine-tuned.
+
+*   `Flickr8kImages` - Each image of the dataset once, with its file name.
+*   `build_feature_cache` - Encodes every image with `encode_fn` (put the encoder in `eval()` mode and use a test transform) and writes `cache_file` plus `cache_file + ".json"` with the image order.
+*   `get_cached_loader` - Same batches as `get_loader`, with the cached activations in place of the images.
+"""
+
+class Flickr8kImages(Dataset):
+    def __init__(self, dataset, transform=None):
+        self.dataset = dataset
+        self.transform = transform
+        self.ids = list(dict.fromkeys(dataset.imgs.tolist()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        img_id = self.ids[index]
+        img = self.dataset.load_image(img_id)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, img_id
+
+
+class FeatureCache:
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        with open(cache_file + ".json") as file:
+            ids = json.load(file)["ids"]
+        self.index = {img_id: row for row, img_id in enumerate(ids)}
+        self.features = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # every DataLoader worker maps the file itself instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state["features"] = None
+        return state
+
+    def __getitem__(self, img_id):
+        if self.features is None:
+            self.features = np.load(self.cache_file, mmap_mode="r")
+        return torch.from_numpy(np.array(self.features[self.index[img_id]]))
+
+
+def build_feature_cache(encode_fn, dataset, transform, cache_file, device, batch_size=64, num_workers=2):
+    images = Flickr8kImages(dataset, transform=transform)
+    loader = DataLoader(images, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=True)
+    features = None
+
+    with torch.no_grad():
+        for idx, (imgs, _) in tqdm(
+            enumerate(loader), total=len(loader), leave=True, position=0
+        ):
+            out = encode_fn(imgs.to(device)).half().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(cache_file, mode="w+", dtype=np.float16, shape=(len(images),) + out.shape[1:])
+            features[idx*batch_size : idx*batch_size + len(out)] = out
+
+    features.flush()
+    with open(cache_file + ".json", "w") as file:
+        json.dump({"ids": images.ids}, file)
+    return FeatureCache(cache_file)
+
+
+class CachedFeatureDataset(Dataset):
+    def __init__(self, dataset, feature_cache):
+        self.dataset = dataset
+        self.feature_cache = feature_cache
+        self.vocab = dataset.vocab
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img_id = self.dataset.imgs[index]
+        return self.feature_cache[img_id], self.dataset.caption_tensor(index), img_id
+
+
+def get_cached_loader(
+    dataset,
+    feature_cache,
+    batch_size=32,
+    num_workers=2,
+    shuffle=True,
+    pin_memory=True,
+    resumable=False):
+
+    cached_dataset = CachedFeatureDataset(dataset, feature_cache)
+
+    pad_idx = dataset.vocab.stoi["<pad>"]
+
+    sampler = ResumableRandomSampler(cached_dataset) if resumable else None
+
+    loader = DataLoader(
+        dataset=cached_dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        pin_memory=pin_memory,
+        collate_fn=MyCollate(pad_idx=pad_idx),
+    )
+
+    return loader, cached_dataset
+
 """## *Download Flickr8k Dataset*
 
 
@@ -400,15 +1094,16 @@ with open('kaggle.json', 'w') as file:
 !chmod 600 /root/.kaggle/kaggle.json
 !kaggle datasets download -d adityajn105/flickr8k
 
-"""## *Extract .zip File*"""
+"""## *Extract captions*
+Only `captions.txt` is extracted, the images are read from the zip file (see *Read images from the archive*).
+"""
 
-import zipfile
 with zipfile.ZipFile('./flickr8k.zip', 'r') as zip_ref:
-    zip_ref.extractall('./flickr8k')
+    zip_ref.extract('captions.txt', './flickr8k')
 
 """## *Files Directories*
 
-*   `path_images` - Directory for dataset images.
+*   `path_images` - Directory for dataset images (only read if the loaders are created without `archive`).
 *   `path_captions` - Directory for dataset captions.
 *   `path_examples` - Directory for sample images to display.
 *   `path_checkpoints` - Directory for model checkpoints.
@@ -421,18 +1116,33 @@ path_captions="/content/flickr8k/captions.txt"
 path_examples=""  #Images to caption
 path_checkpoints="" #Model checkpoints
 
+"""## *Read images from the archive*
+The images are never extracted: the loaders read them from `path_archive` through `archive_reader`, whose central directory index is built once here and shared by all loaders (`image_reader=archive_reader` in `create_loader`).
+Repacking into tar shards enables sequential streaming with `get_stream_loader`.
+
+*   `path_archive` - Downloaded dataset zip.
+*   `path_shards` - Directory for the repacked tar shards.
+"""
+
+path_archive="./flickr8k.zip"
+path_shards="./flickr8k_shards"
+
+archive_reader = open_archive(path_archive)
+shard_reader = repack_tar_shards(archive_reader, pd.read_csv(path_captions)["image"], path_shards)
+
 """## *Display samples from dataset*
 *   `path_images` - Directory for dataset images.
 *   `path_captions` - Directory for dataset captions.
+*   `image_reader` - Optional `open_archive` reader to read the images from.
 """
 
-def display_samples(path_images, path_captions):
+def display_samples(path_images, path_captions, image_reader=None):
   display_transform = transforms.Compose([
         transforms.Resize((224, 224)), 
         transforms.ToTensor(),
         ])
 
-  display_loader, display_dataset = get_loader(path_images,path_captions,batch_size=2,transform=display_transform)
+  display_loader, display_dataset = get_loader(path_images,path_captions,batch_size=2,transform=display_transform,image_reader=image_reader)
   display_iter = iter(display_loader)
   images, captions, ids = display_iter.next()
   fig, axes = plt.subplots(len(images),1, figsize=(2.5,5))
@@ -442,7 +1152,7 @@ def display_samples(path_images, path_captions):
     axes[idx].set_xticks([])
     axes[idx].set_yticks([])
 
-display_samples(path_images, path_captions)
+display_samples(path_images, path_captions, image_reader=archive_reader)
 
 """# **Dataset Loaders**
 
@@ -480,35 +1190,121 @@ def create_transform(split='train', model=2):
       
   return transform
 
+"""## *uint8 Loader Mode*
+Workers only decode and resize, so batches are collated and pinned as uint8 (4x fewer bytes than float32).
+Random crop, conversion to float and normalization then run once per batch on the device with `BatchTransform`.
+
+*   `create_uint8_transform` - Per-image part of `create_transform`: resize to the pre-crop size and convert to a uint8 tensor.
+*   `create_batch_transform` - The matching batch part, apply it to `imgs` after `.to(device)` (`batch_transform` argument of the train functions).
+*   `benchmark_loader` - Loader throughput in images/sec, including the batch transform.
+"""
+
+def create_uint8_transform(split='train', model=2):
+  if model == 1:
+    size = (299, 299) if split == 'test' else (356, 356)
+  else:
+    size = (224, 224) if split == 'test' else (226, 226)
+  return transforms.Compose([
+        transforms.Resize(size),
+        transforms.PILToTensor(),])
+
+class BatchTransform(nn.Module):
+    def __init__(self, mean, std, crop_size=None):
+        super(BatchTransform, self).__init__()
+        self.crop_size = crop_size
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1) * 255)
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1) * 255)
+
+    def random_crop(self, imgs):
+        # one random offset per image, gathered with a single advanced index
+        batch_size, channels, height, width = imgs.shape
+        crop_h, crop_w = self.crop_size
+        top = torch.randint(0, height - crop_h + 1, (batch_size,), device=imgs.device)
+        left = torch.randint(0, width - crop_w + 1, (batch_size,), device=imgs.device)
+        rows = (top.unsqueeze(1) + torch.arange(crop_h, device=imgs.device)).view(batch_size, 1, crop_h, 1)
+        cols = (left.unsqueeze(1) + torch.arange(crop_w, device=imgs.device)).view(batch_size, 1, 1, crop_w)
+        batch = torch.arange(batch_size, device=imgs.device).view(-1, 1, 1, 1)
+        channel = torch.arange(channels, device=imgs.device).view(1, -1, 1, 1)
+        return imgs[batch, channel, rows, cols]
+
+    def forward(self, imgs):
+        if self.crop_size is not None:
+            imgs = self.random_crop(imgs)
+        return (imgs.float() - self.mean) / self.std
+
+def create_batch_transform(split='train', model=2):
+  crop_size = None
+  if model == 1:
+    if split != 'test':
+      crop_size = (299, 299)
+    return BatchTransform((0.5, 0.5, 0.5), (0.5, 0.5, 0.5), crop_size)
+  if split != 'test':
+    crop_size = (224, 224)
+  return BatchTransform((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), crop_size)
+
+def benchmark_loader(loader, device, num_batches=50, batch_transform=None):
+    num_images = 0
+    start = time.time()
+    for idx, (imgs, _, _) in enumerate(loader):
+        if idx == num_batches:
+            break
+        imgs = imgs.to(device, non_blocking=True)
+        if batch_transform is not None:
+            imgs = batch_transform(imgs)
+        num_images += len(imgs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    images_per_sec = num_images / (time.time() - start)
+    print(f"{images_per_sec:.1f} images/sec")
+    return images_per_sec
+
 """## *Create Loader*
 *   `path_images` - Directory for dataset images.
 *   `path_captions` - Directory for dataset captions.
 *   `split` - Default value is `train`.
 *   `model` - `1` for Model 1, `2` for Model 2, default is `2`.
+*   `resumable` - If `True` then the loader order can be resumed mid-epoch.
+*   `archive` - Optional zip file or tar shards directory to read the images from (see `open_archive`).
+*   `image_reader` - Optional already opened reader, shared between the loaders instead of opening `archive` for each.
+*   `uint8` - If `True` then the images stay uint8 until `create_batch_transform` runs on the batch.
+*   `num_workers`, `persistent_workers`, `prefetch_factor` - Worker settings passed to `get_loader`.
 
 
 """
 
-def create_loader(path_images, path_captions, split='', model=2):
-  transform = create_transform(split, model)
+def create_loader(path_images, path_captions, split='', model=2, resumable=False, archive=None, uint8=False, num_workers=2, persistent_workers=False, prefetch_factor=2, image_reader=None):
+  transform = create_uint8_transform(split, model) if uint8 else create_transform(split, model)
   return get_loader(
         root_folder=path_images,
         annotation_file=path_captions,
-        transform=transform,split=split)
+        transform=transform,split=split,resumable=resumable,archive=archive,image_reader=image_reader,
+        num_workers=num_workers,persistent_workers=persistent_workers,prefetch_factor=prefetch_factor)
 
 transform_Inception_Test = create_transform(split='test', model=1)
 transform_Inception_Train = create_transform(split='train', model=1)
 transform_Resnet_Test = create_transform(split='test', model=2)
 transform_Resnet_Train = create_transform(split='train', model=2)
 
-train_loader_inception, train_dataset_inception = create_loader(path_images, path_captions, split='train', model=1)
-train_loader_resnet, train_dataset_resnet = create_loader(path_images, path_captions, split='train', model=2)
+train_loader_inception, train_dataset_inception = create_loader(path_images, path_captions, split='train', model=1, resumable=True, image_reader=archive_reader)
+train_loader_resnet, train_dataset_resnet = create_loader(path_images, path_captions, split='train', model=2, resumable=True, image_reader=archive_reader)
+
+total_loader_inception, total_dataset_inception = create_loader(path_images, path_captions, model=1, image_reader=archive_reader)
+total_loader_resnet, total_dataset_resnet = create_loader(path_images, path_captions, model=2, image_reader=archive_reader)
 
-total_loader_inception, total_dataset_inception = create_loader(path_images, path_captions, model=1)
-total_loader_resnet, total_dataset_resnet = create_loader(path_images, path_captions, model=2)
+test_loader_inception, test_dataset_inception = create_loader(path_images, path_captions, split='test', model=1, image_reader=archive_reader)
+test_loader_resnet, test_dataset_resnet = create_loader(path_images, path_captions, split='test', model=2, image_reader=archive_reader)
 
-test_loader_inception, test_dataset_inception = create_loader(path_images, path_captions, split='test', model=1)
-test_loader_resnet, test_dataset_resnet = create_loader(path_images, path_captions, split='test', model=2)
+# sequential alternative to train_loader_resnet, without mid-epoch resume
+stream_loader_resnet, _ = get_stream_loader(train_dataset_resnet, path_shards, transform_Resnet_Train)
+
+"""## *Loader throughput*"""
+
+uint8_loader_resnet, _ = create_loader(path_images, path_captions, split='train', model=2, resumable=True, image_reader=archive_reader, uint8=True, persistent_workers=True, prefetch_factor=4)
+batch_transform_Resnet_Train = create_batch_transform(split='train', model=2).to(device)
+
+benchmark_loader(train_loader_resnet, device)
+benchmark_loader(stream_loader_resnet, device)
+benchmark_loader(uint8_loader_resnet, device, batch_transform=batch_transform_Resnet_Train)
 
 """# **Model 1**
 CNN-RNN with Single layer LSTM without Attention
@@ -536,61 +1332,122 @@ class EncoderCNN(nn.Module):
         features = self.inception(images)
         return self.dropout(self.relu(features))
 
+    def pool_features(self, images):
+        # Inception output before `fc`, used to cache the frozen part of the encoder
+        fc = self.inception.fc
+        self.inception.fc = nn.Identity()
+        try:
+            return self.inception(images)
+        finally:
+            self.inception.fc = fc
+
+    def forward_cached(self, pooled):
+        features = self.inception.fc(f.dropout(pooled.float(), p=0.5, training=self.training))
+        return self.dropout(self.relu(features))
+
 class DecoderRNN(nn.Module):
-    def __init__(self, embed_size, hidden_size, vocab_size, num_layers):
+    def __init__(self, embed_size, hidden_size, vocab_size, num_layers, token_counts=None, cutoffs=None):
         super(DecoderRNN, self).__init__()
         self.embed = nn.Embedding(vocab_size, embed_size)
         self.lstm = nn.LSTM(embed_size, hidden_size, num_layers)
-        self.linear = nn.Linear(hidden_size, vocab_size)
+        if token_counts is None:
+            self.linear = nn.Linear(hidden_size, vocab_size)
+        else:
+            self.linear = AdaptiveHead(hidden_size, vocab_size, token_counts, cutoffs)
         self.dropout = nn.Dropout(0.5)
 
-    def forward(self, features, captions):
+    def forward(self, features, captions, return_hidden=False):
         embeddings = self.dropout(self.embed(captions))
         embeddings = torch.cat((features.unsqueeze(0), embeddings), dim=0)
         hiddens, _ = self.lstm(embeddings)
+        if return_hidden:
+            return hiddens
         outputs = self.linear(hiddens)
         return outputs
 
+    def predict(self, hiddens):
+        if isinstance(self.linear, AdaptiveHead):
+            return self.linear.predict(hiddens)
+        return self.linear(hiddens).argmax(1)
+
+    def log_probs(self, hiddens):
+        if isinstance(self.linear, AdaptiveHead):
+            return self.linear(hiddens)
+        return f.log_softmax(self.linear(hiddens), dim=-1)
+
 
 class CNNtoRNN(nn.Module):
-    def __init__(self, embed_size, hidden_size, vocab_size, num_layers):
+    def __init__(self, embed_size, hidden_size, vocab_size, num_layers, token_counts=None, cutoffs=None, encoder=None):
         super(CNNtoRNN, self).__init__()
-        self.encoderCNN = EncoderCNN(embed_size)
-        self.decoderRNN = DecoderRNN(embed_size, hidden_size, vocab_size, num_layers)
+        self.encoderCNN = EncoderCNN(embed_size) if encoder is None else encoder
+        self.decoderRNN = DecoderRNN(embed_size, hidden_size, vocab_size, num_layers, token_counts, cutoffs)
 
-    def forward(self, images, captions):
-        features = self.encoderCNN(images)
-        outputs = self.decoderRNN(features, captions)
+    def forward(self, images, captions, cached=False, return_hidden=False):
+        features = self.encoderCNN.forward_cached(images) if cached else self.encoderCNN(images)
+        outputs = self.decoderRNN(features, captions, return_hidden=return_hidden)
         return outputs
 
-    def caption_image(self, image, vocabulary, max_length=50):
+    def caption_image(self, image, vocabulary, max_length=50, return_logprob=False):
         result_caption = []
+        logprob = 0.0
 
         with torch.no_grad():
             x = self.encoderCNN(image).unsqueeze(0)
             states = None
 
-            for _ in range(max_length):
+            for step in range(max_length):
                 hiddens, states = self.decoderRNN.lstm(x, states)
-                output = self.decoderRNN.linear(hiddens.squeeze(0))
-                predicted = output.argmax(1)
+                if return_logprob:
+                    log_probs = self.decoderRNN.log_probs(hiddens.squeeze(0))
+                    predicted = log_probs.argmax(1)
+                    # a leading <sos> is the start token of the training captions, not a caption word
+                    if step > 0 or predicted.item() != vocabulary.stoi["<sos>"]:
+                        logprob += log_probs[0, predicted].item()
+                else:
+                    predicted = self.decoderRNN.predict(hiddens.squeeze(0))
                 result_caption.append(predicted.item())
                 x = self.decoderRNN.embed(predicted).unsqueeze(0)
 
                 if vocabulary.itos[predicted.item()] == "<eos>":
                     break
 
+        if return_logprob:
+            return [vocabulary.itos[idx] for idx in result_caption], logprob
         return [vocabulary.itos[idx] for idx in result_caption]
 
+    def score_captions(self, images, candidates, vocabulary, length_norm=True, max_batch=1024):
+        # teacher-forced log-likelihood of every candidate, each image is encoded once
+        training = self.training
+        self.eval()
+        tokens, owners = pad_candidates(candidates, vocabulary)
+        scores = []
+
+        with torch.no_grad():
+            features = self.encoderCNN(images)
+            for start in range(0, len(tokens), max_batch):
+                batch = tokens[start:start + max_batch].to(features.device)
+                feats = features[owners[start:start + max_batch].to(features.device)]
+                hiddens = self.decoderRNN(feats, batch.t()[:-1], return_hidden=True)    #(seq_len,num_candidates,hidden_size)
+                log_probs = self.decoderRNN.log_probs(hiddens[1:]).transpose(0, 1)     # skip the <sos> prediction
+                scores.append(sequence_log_likelihood(log_probs, batch[:, 1:], vocabulary.stoi["<pad>"], length_norm).cpu())
+
+        self.train(training)
+        return split_scores(torch.cat(scores), owners, len(candidates))
+
 """## *Train function*
 *   `hyperparam` - Hyperparameters from the Hyperparameters Class.
 *   `train_CNN` - If `True` then fine tunes the pre trained encoder.
 *   `load_model` - If `True` then resumes training from checkpoint.
 *   `save_model` - If `True` then saves checkpoints after each epoch.
 *   `model_file` - Saves and loads checkpoints from directory `path_checkpoints+model_file`.
+*   `checkpoint_steps` - If set then also saves a checkpoint every `checkpoint_steps` batches.
+*   `checkpoint_secs` - If set then also saves a checkpoint every `checkpoint_secs` seconds.
+*   Mid-epoch checkpoints require a loader created with `resumable=True`; resuming restarts at the next batch.
+*   `cached_features` - If `True` then `train_loader` comes from `get_cached_loader` and yields encoder activations instead of images; `train_CNN` then only applies to the layers after the cached prefix.
+*   `batch_transform` - Applied to each batch on the device, for loaders created with `uint8=True`.
 """
 
-def train_LSTM_pretrained(train_loader, dataset, hyperparam , device, model_file='',save_model=True,train_CNN=False,load_model=False, cudnn_benchmark=True):
+def train_LSTM_pretrained(train_loader, dataset, hyperparam , device, model_file='',save_model=True,train_CNN=False,load_model=False, cudnn_benchmark=True, checkpoint_steps=None, checkpoint_secs=None, cached_features=False, batch_transform=None):
 
     torch.backends.cudnn.benchmark = cudnn_benchmark
     losses = []
@@ -608,7 +1465,8 @@ def train_LSTM_pretrained(train_loader, dataset, hyperparam , device, model_file
     num_epochs = hyperparam.num_epochs
 
     # initialize model, loss etc
-    model = CNNtoRNN(embed_size, hidden_size, vocab_size, num_layers).to(device)
+    token_counts = dataset.vocab.token_counts() if hyper.output_head == 'adaptive' else None
+    model = CNNtoRNN(embed_size, hidden_size, vocab_size, num_layers, token_counts, hyper.cutoffs).to(device)
     criterion = nn.CrossEntropyLoss(ignore_index=dataset.vocab.stoi["<pad>"])
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
@@ -619,48 +1477,62 @@ def train_LSTM_pretrained(train_loader, dataset, hyperparam , device, model_file
         else:
             param.requires_grad = train_CNN
     
+    sampler = train_loader.sampler if isinstance(train_loader.sampler, ResumableRandomSampler) else None
+    if (checkpoint_steps is not None or checkpoint_secs is not None) and sampler is None:
+        raise ValueError("Mid-epoch checkpoints require a loader created with resumable=True")
+
     start_epoch = 1
+    resume = None
     if load_model:
         start_epoch, losses_loaded = load_checkpoint(path_checkpoints+model_file, model, optimizer, device)
         start_epoch += 1
         losses = losses_loaded
+        resume = load_resume_state(path_checkpoints+model_file, device)
     model.train()
+    last_save = time.time()
     
     for epoch in range(num_epochs+1)[start_epoch:]:
         # Uncomment the line below to see a couple of test cases
         # print_examples(model, device, dataset)
+
+        start_step = resume["step"] if resume is not None else 0
+        start_sample = resume["sample"] if resume is not None else 0
+        resume = None
+        if sampler is not None:
+            sampler.set_position(epoch, start_sample)
+        if hasattr(train_loader.dataset, "set_epoch"):
+            train_loader.dataset.set_epoch(epoch)
         
         for idx, (imgs, captions,_) in tqdm(
             enumerate(train_loader), total=len(train_loader), leave=True, position=0
         ):
             imgs = imgs.to(device)
             captions = captions.to(device)
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
 
-            outputs = model(imgs, captions[:-1])
-            loss = criterion(
-                outputs.reshape(-1, outputs.shape[2]), captions.reshape(-1)
-            )
+            loss = caption_loss(model, imgs, captions, criterion, attention=False, cached=cached_features, chunk_size=hyper.loss_chunk_size)
 
             optimizer.zero_grad()
             loss.backward(loss)
             optimizer.step()
+
+            step = start_step + idx + 1
+            if save_model and idx + 1 < len(train_loader) and checkpoint_due(step, last_save, checkpoint_steps, checkpoint_secs):
+                position = {"step": step, "sample": start_sample + (idx + 1) * train_loader.batch_size, "loss": loss.item()}
+                save_checkpoint(training_state(model, optimizer, epoch - 1, losses, hyper, resume=position), path_checkpoints+model_file)
+                last_save = time.time()
         losses.append(loss.item())
         if save_model:
-            checkpoint = {
-                "state_dict": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "epoch": epoch,
-                "losses": losses,
-                "hyperparams": hyper
-            }
-            save_checkpoint(checkpoint, path_checkpoints+model_file)    
+            save_checkpoint(training_state(model, optimizer, epoch, losses, hyper), path_checkpoints+model_file)
+            last_save = time.time()
         print(f"Epoch {epoch} - Loss = {loss.item()}")
     return losses
 
 """## *Train model and evaluate*"""
 
 LSTM_hyperparam = Hyperparameters(embed_size=256, hidden_size=256, vocab_size=len(train_dataset_inception.vocab), num_layers=1, learning_rate=3e-4, num_epochs=100)
-losses_no_Attention = train_LSTM_pretrained(train_loader_inception, train_dataset_inception, LSTM_hyperparam, device, model_file="/LSTM_ckpt.pth", load_model=True)
+losses_no_Attention = train_LSTM_pretrained(train_loader_inception, train_dataset_inception, LSTM_hyperparam, device, model_file="/LSTM_ckpt.pth", load_model=True, checkpoint_steps=200)
 
 fig = plt.figure(figsize=(8, 5)) 
 ax = fig.add_subplot(1, 1 ,1) 
@@ -681,6 +1553,16 @@ print_examples(model, device, test_dataset_inception,path_examples, transform_In
 
 calc_bleu(total_loader_resnet,model, total_dataset_resnet, device, path_images, path_captions, transform_Inception_Test, attention=False, num_batches=20, multiple_ref=True)
 
+"""## *Fine-tune from cached pool features*
+Inception runs once per image up to `fc`; only `fc` and the decoder are trained from the cache.
+"""
+
+encoder_inception = EncoderCNN(LSTM_hyperparam.embed_size).to(device).eval()
+inception_cache = build_feature_cache(encoder_inception.pool_features, train_dataset_inception, transform_Inception_Test, "inception_pool.npy", device)
+del encoder_inception
+cached_loader_inception, _ = get_cached_loader(train_dataset_inception, inception_cache, resumable=True)
+losses_cached_LSTM = train_LSTM_pretrained(cached_loader_inception, train_dataset_inception, LSTM_hyperparam, device, model_file="/LSTM_cached_ckpt.pth", cached_features=True)
+
 """# **Model 2**
 CNN-RNN with Single layer LSTM with Soft Attention
 
@@ -702,10 +1584,18 @@ class EncoderResnet(nn.Module):
         
         modules = list(resnet.children())[:-2]
         self.resnet = nn.Sequential(*modules)
+        # self.resnet[:7] runs up to layer3, self.resnet[7] is layer4
+        self.num_prefix = 7
         
 
     def forward(self, images):
-        features = self.resnet(images)                                    #(batch_size,2048,7,7)
+        return self.forward_cached(self.encode_prefix(images))
+
+    def encode_prefix(self, images):
+        return self.resnet[:self.num_prefix](images)                      #(batch_size,1024,14,14)
+
+    def forward_cached(self, prefix):
+        features = self.resnet[self.num_prefix:](prefix.float())          #(batch_size,2048,7,7)
         features = features.permute(0, 2, 3, 1)                           #(batch_size,7,7,2048)
         features = features.view(features.size(0), -1, features.size(-1)) #(batch_size,49,2048)
         return features
@@ -741,7 +1631,7 @@ class Attention(nn.Module):
                 
 
 class DecoderAttention(nn.Module):
-    def __init__(self,embed_size, vocab_size, attention_dim,encoder_dim,decoder_dim,drop_prob=0.3):
+    def __init__(self,embed_size, vocab_size, attention_dim,encoder_dim,decoder_dim,drop_prob=0.3,token_counts=None,cutoffs=None):
         super().__init__()
         
         #save the model param
@@ -759,12 +1649,15 @@ class DecoderAttention(nn.Module):
         self.f_beta = nn.Linear(decoder_dim, encoder_dim)
         
         
-        self.fcn = nn.Linear(decoder_dim,vocab_size)
+        if token_counts is None:
+            self.fcn = nn.Linear(decoder_dim,vocab_size)
+        else:
+            self.fcn = AdaptiveHead(decoder_dim, vocab_size, token_counts, cutoffs)
         self.drop = nn.Dropout(drop_prob)
         
         
     
-    def forward(self, features, captions):
+    def forward(self, features, captions, return_hidden=False):
         
         #vectorize the caption
         embeds = self.embedding(captions)
@@ -777,6 +1670,17 @@ class DecoderAttention(nn.Module):
         batch_size = captions.size(0)
         num_features = features.size(1)
         
+        # with return_hidden only the hidden states are kept and the projection is left to the
+        # caller (AdaptiveHead.loss, chunked_cross_entropy), the attention weights are not stored
+        if return_hidden:
+            hiddens = []
+            for s in range(seq_length):
+                alpha,context = self.attention(features, h)
+                lstm_input = torch.cat((embeds[:, s], context), dim=1)
+                h, c = self.lstm_cell(lstm_input, (h, c))
+                hiddens.append(self.drop(h))
+            return torch.stack(hiddens, dim=1), None
+
         preds = torch.zeros(batch_size, seq_length, self.vocab_size).to(device)
         alphas = torch.zeros(batch_size, seq_length,num_features).to(device)
                 
@@ -793,7 +1697,7 @@ class DecoderAttention(nn.Module):
         
         return preds, alphas
     
-    def generate_caption(self,features,max_len=20,vocab=None):
+    def generate_caption(self,features,max_len=20,vocab=None,return_logprob=False):
         # Inference part
         # Given the image features generate the captions
         
@@ -808,6 +1712,7 @@ class DecoderAttention(nn.Module):
 
         
         captions = [vocab.stoi["<sos>"]]
+        logprob = 0.0
         
         for i in range(max_len):
             alpha,context = self.attention(features, h)
@@ -818,12 +1723,15 @@ class DecoderAttention(nn.Module):
             
             lstm_input = torch.cat((embeds[:, 0], context), dim=1)
             h, c = self.lstm_cell(lstm_input, (h, c))
-            output = self.fcn(self.drop(h))
-            output = output.view(batch_size,-1)
         
             
             #select the word with most val
-            predicted_word_idx = output.argmax(dim=1)
+            if return_logprob:
+                log_probs = self.log_probs(self.drop(h))
+                predicted_word_idx = log_probs.argmax(dim=1)
+                logprob += log_probs[0, predicted_word_idx].item()
+            else:
+                predicted_word_idx = self.predict(self.drop(h))
             
             #save the generated word
             captions.append(predicted_word_idx.item())
@@ -836,9 +1744,48 @@ class DecoderAttention(nn.Module):
             embeds = self.embedding(predicted_word_idx.unsqueeze(0))
         
         #covert the vocab idx to words and return sentence
+        if return_logprob:
+            return [vocab.itos[idx] for idx in captions],alphas,logprob
         return [vocab.itos[idx] for idx in captions],alphas
     
     
+    def predict(self, h):
+        if isinstance(self.fcn, AdaptiveHead):
+            return self.fcn.predict(h)
+        return self.fcn(h).argmax(dim=1)
+
+    def log_probs(self, h):
+        if isinstance(self.fcn, AdaptiveHead):
+            return self.fcn(h)
+        return f.log_softmax(self.fcn(h), dim=-1)
+
+    def grouped_hiddens(self, features, captions):
+        # hidden states of num_captions captions per image (batch_size,num_captions,seq_len) for score_captions.
+        # Everything that only depends on the image is computed once per image instead of per caption:
+        # U(features), the initial state and the LSTM input weights applied to the features, which the
+        # attention weights then combine (alpha @ (features @ W) == (alpha @ features) @ W).
+        batch_size, num_captions, seq_len = captions.shape
+        embed_size = self.embedding.embedding_dim
+        weight_embed, weight_context = self.lstm_cell.weight_ih.split([embed_size, features.size(2)], dim=1)
+
+        u_hs = self.attention.U(features)                                      #(batch_size,num_layers,attention_dim)
+        context_gates = features @ weight_context.t()                          #(batch_size,num_layers,4*decoder_dim)
+        embed_gates = self.embedding(captions) @ weight_embed.t() + self.lstm_cell.bias_ih + self.lstm_cell.bias_hh
+        h, c = self.init_hidden_state(features)
+        h = h.unsqueeze(1).expand(-1, num_captions, -1)                        #(batch_size,num_captions,decoder_dim)
+        c = c.unsqueeze(1).expand(-1, num_captions, -1)
+
+        hiddens = []
+        for s in range(seq_len - 1):
+            combined_states = torch.tanh_(u_hs.unsqueeze(1) + self.attention.W(h).unsqueeze(2))    #(batch_size,num_captions,num_layers,attention_dim)
+            alpha = f.softmax(self.attention.A(combined_states).squeeze(3), dim=2)                 #(batch_size,num_captions,num_layers)
+            gates = embed_gates[:, :, s] + torch.bmm(alpha, context_gates) + h @ self.lstm_cell.weight_hh.t()
+            i, f_gate, g, o = gates.chunk(4, dim=2)                            # nn.LSTMCell gate order
+            c = torch.sigmoid(f_gate) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            hiddens.append(self.drop(h))
+        return torch.stack(hiddens, dim=2).view(batch_size * num_captions, seq_len - 1, -1)
+
     def init_hidden_state(self, encoder_out):
         mean_encoder_out = encoder_out.mean(dim=1)
         h = self.init_h(mean_encoder_out)  # (batch_size, decoder_dim)
@@ -846,24 +1793,55 @@ class DecoderAttention(nn.Module):
         return h, c                
 
 class EncoderDecoder(nn.Module):
-    def __init__(self,embed_size, vocab_size, attention_dim,  encoder_dim, decoder_dim, drop_prob=0.3):
+    def __init__(self,embed_size, vocab_size, attention_dim,  encoder_dim, decoder_dim, drop_prob=0.3, token_counts=None, cutoffs=None, encoder=None):
         super().__init__()
-        self.encoder = EncoderResnet()
+        self.encoder = EncoderResnet() if encoder is None else encoder
         self.decoder = DecoderAttention(
             embed_size=embed_size,
             vocab_size = vocab_size,
             attention_dim=attention_dim,
             encoder_dim=encoder_dim,
-            decoder_dim=decoder_dim
+            decoder_dim=decoder_dim,
+            token_counts=token_counts,
+            cutoffs=cutoffs
         )
         
-    def forward(self, images, captions):
-        features = self.encoder(images)
-        outputs = self.decoder(features, captions)
+    def forward(self, images, captions, cached=False, return_hidden=False):
+        features = self.encoder.forward_cached(images) if cached else self.encoder(images)
+        outputs = self.decoder(features, captions, return_hidden=return_hidden)
         return outputs
 
-    def caption_image(self, image, vocabulary, max_length=50):
-        return self.decoder.generate_caption(self.encoder(image[0:1]), max_length, vocabulary)
+    def caption_image(self, image, vocabulary, max_length=50, return_logprob=False):
+        return self.decoder.generate_caption(self.encoder(image[0:1]), max_length, vocabulary, return_logprob=return_logprob)
+
+    def score_captions(self, images, candidates, vocabulary, length_norm=True, max_batch=128):
+        # teacher-forced log-likelihood of every candidate, each image is encoded once
+        training = self.training
+        self.eval()
+        tokens, owners = pad_candidates(candidates, vocabulary)
+        pad_idx = vocabulary.stoi["<pad>"]
+
+        # candidates grouped per image (num_images,num_captions,seq_len), padded with empty captions
+        counts = torch.bincount(owners, minlength=len(candidates))
+        num_captions = max(1, counts.max().item())
+        ranks = torch.arange(len(owners)) - (counts.cumsum(0) - counts)[owners]
+        grouped = torch.full((len(candidates), num_captions, tokens.size(1)), pad_idx, dtype=torch.long)
+        grouped[owners, ranks] = tokens
+        images_per_batch = max(1, max_batch // num_captions)
+        scores = []
+
+        with torch.no_grad():
+            features = self.encoder(images)
+            for start in range(0, len(candidates), images_per_batch):
+                batch = grouped[start:start + images_per_batch].to(features.device)
+                hiddens = self.decoder.grouped_hiddens(features[start:start + images_per_batch], batch)
+                log_probs = self.decoder.log_probs(hiddens)
+                targets = batch[:, :, 1:].reshape(-1, batch.size(2) - 1)
+                scores.append(sequence_log_likelihood(log_probs, targets, pad_idx, length_norm).view(len(batch), num_captions).cpu())
+
+        self.train(training)
+        scores = torch.cat(scores)
+        return [scores[i, :counts[i]] for i in range(len(candidates))]
 
 """## *Train function*
 *   `hyperparam` - Hyperparameters from the Hyperparameters Class.
@@ -871,9 +1849,14 @@ class EncoderDecoder(nn.Module):
 *   `load_model` - If `True` then resumes training from checkpoint.
 *   `save_model` - If `True` then saves checkpoints after each epoch.
 *   `model_file` - Saves and loads checkpoints from directory `path_checkpoints+model_file`.
+*   `checkpoint_steps` - If set then also saves a checkpoint every `checkpoint_steps` batches.
+*   `checkpoint_secs` - If set then also saves a checkpoint every `checkpoint_secs` seconds.
+*   Mid-epoch checkpoints require a loader created with `resumable=True`; resuming restarts at the next batch.
+*   `cached_features` - If `True` then `train_loader` comes from `get_cached_loader` and yields encoder activations instead of images; `train_CNN` then only applies to the layers after the cached prefix.
+*   `batch_transform` - Applied to each batch on the device, for loaders created with `uint8=True`.
 """
 
-def train_Attention(train_loader, dataset, hyperparam , device ,model_file='',save_model=True,train_CNN=False,load_model=False, cudnn_benchmark=True):
+def train_Attention(train_loader, dataset, hyperparam , device ,model_file='',save_model=True,train_CNN=False,load_model=False, cudnn_benchmark=True, checkpoint_steps=None, checkpoint_secs=None, cached_features=False, batch_transform=None):
 
     torch.backends.cudnn.benchmark = cudnn_benchmark
     losses = []
@@ -892,56 +1875,76 @@ def train_Attention(train_loader, dataset, hyperparam , device ,model_file='',sa
     num_epochs = hyperparam.num_epochs
 
     # initialize model, loss etc
-    model = EncoderDecoder(embed_size, vocab_size, attention_dim, encoder_dim, decoder_dim).to(device)
+    token_counts = dataset.vocab.token_counts() if hyper.output_head == 'adaptive' else None
+    model = EncoderDecoder(embed_size, vocab_size, attention_dim, encoder_dim, decoder_dim, token_counts=token_counts, cutoffs=hyper.cutoffs).to(device)
     criterion = nn.CrossEntropyLoss(ignore_index=dataset.vocab.stoi["<pad>"])
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
     # Only finetune the CNN
-    if train_CNN:
-      for param in model.EncoderResnet.resnet.parameters():
+    if cached_features:
+      # the cached prefix (up to layer3) is never run, only layer4 can be finetuned
+      for param in model.encoder.resnet[model.encoder.num_prefix:].parameters():
+              param.requires_grad = train_CNN
+    elif train_CNN:
+      for param in model.encoder.resnet.parameters():
               param.requires_grad = True
 
+    sampler = train_loader.sampler if isinstance(train_loader.sampler, ResumableRandomSampler) else None
+    if (checkpoint_steps is not None or checkpoint_secs is not None) and sampler is None:
+        raise ValueError("Mid-epoch checkpoints require a loader created with resumable=True")
+
     start_epoch = 1
+    resume = None
     if load_model:
         start_epoch, losses_loaded = load_checkpoint(path_checkpoints+model_file, model, optimizer, device)
         start_epoch += 1
         losses = losses_loaded
+        resume = load_resume_state(path_checkpoints+model_file, device)
     model.train()
+    last_save = time.time()
     
     for epoch in range(num_epochs+1)[start_epoch:]:
         # Uncomment the line below to see a couple of test cases
         # print_examples(model, device, dataset)
+
+        start_step = resume["step"] if resume is not None else 0
+        start_sample = resume["sample"] if resume is not None else 0
+        resume = None
+        if sampler is not None:
+            sampler.set_position(epoch, start_sample)
+        if hasattr(train_loader.dataset, "set_epoch"):
+            train_loader.dataset.set_epoch(epoch)
         
         for idx, (imgs, captions, _) in tqdm(
             enumerate(train_loader), total=len(train_loader), leave=True, position=0
         ):
             imgs = imgs.to(device)
-            captions = captions.permute(1,0).to(device)
+            captions = captions.to(device)
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
 
-            outputs, attentions = model(imgs, captions )
-            targets = captions[:,1:]
-            loss = criterion(outputs.view(-1, vocab_size), targets.reshape(-1))
+            loss = caption_loss(model, imgs, captions, criterion, attention=True, cached=cached_features, chunk_size=hyper.loss_chunk_size)
 
             optimizer.zero_grad()
             loss.backward(loss)
             optimizer.step()
+
+            step = start_step + idx + 1
+            if save_model and idx + 1 < len(train_loader) and checkpoint_due(step, last_save, checkpoint_steps, checkpoint_secs):
+                position = {"step": step, "sample": start_sample + (idx + 1) * train_loader.batch_size, "loss": loss.item()}
+                save_checkpoint(training_state(model, optimizer, epoch - 1, losses, hyper, resume=position), path_checkpoints+model_file)
+                last_save = time.time()
         losses.append(loss.item())
         if save_model:
-            checkpoint = {
-                "state_dict": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "epoch": epoch,
-                "losses": losses,
-                "hyperparams": hyper
-            }
-            save_checkpoint(checkpoint, path_checkpoints+model_file)    
+            save_checkpoint(training_state(model, optimizer, epoch, losses, hyper), path_checkpoints+model_file)
+            last_save = time.time()
         print(f"Epoch {epoch} - Loss = {loss.item()}")
     return losses
 
 """## *Train model and evaluate*"""
 
 Attention_hyperparam = Hyperparameters(embed_size=300, vocab_size=len(train_dataset_resnet.vocab), learning_rate=3e-4, num_epochs=25,attention_dim=256, encoder_dim=2048,decoder_dim=512)
-losses_Attention = train_Attention(train_loader_resnet, train_dataset_resnet, Attention_hyperparam, device,model_file="/Attention1_ckpt.pth", load_model=False)
+losses_Attention = train_Attention(train_loader_resnet, train_dataset_resnet, Attention_hyperparam, device,model_file="/Attention1_ckpt.pth", load_model=False, checkpoint_steps=200)
 
 fig = plt.figure(figsize=(8, 5)) 
 ax = fig.add_subplot(1, 1 ,1) 
@@ -960,4 +1963,639 @@ optimizer = optim.Adam(model.parameters(), lr=Attention_hyperparam.learning_rate
 _,losses_Attention = load_checkpoint(path_checkpoints+"/Attention_ckpt.pth", model, optimizer, device)
 print_examples(model, device, train_dataset_resnet,path_examples, transform_Resnet_Test, attention=True, max_imgs=16, save=True)
 
-calc_bleu(total_loader_resnet,model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=False)
\ No newline at end of file
+calc_bleu(total_loader_resnet,model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=False)
+
+"""## *Adaptive softmax vs full softmax*
+Trains Model 2 with `output_head='adaptive'` and compares train step time and BLEU with the full softmax model above.
+"""
+
+Adaptive_hyperparam = Hyperparameters(embed_size=300, vocab_size=len(train_dataset_resnet.vocab), learning_rate=3e-4, num_epochs=25,attention_dim=256, encoder_dim=2048,decoder_dim=512, output_head='adaptive')
+losses_Adaptive = train_Attention(train_loader_resnet, train_dataset_resnet, Adaptive_hyperparam, device,model_file="/Attention_adaptive_ckpt.pth", checkpoint_steps=200)
+
+model_adaptive = EncoderDecoder(Adaptive_hyperparam.embed_size, Adaptive_hyperparam.vocab_size, Adaptive_hyperparam.attention_dim, Adaptive_hyperparam.encoder_dim, Adaptive_hyperparam.decoder_dim, token_counts=train_dataset_resnet.vocab.token_counts()).to(device)
+optimizer_adaptive = optim.Adam(model_adaptive.parameters(), lr=Adaptive_hyperparam.learning_rate)
+load_checkpoint(path_checkpoints+"/Attention_adaptive_ckpt.pth", model_adaptive, optimizer_adaptive, device)
+
+criterion = nn.CrossEntropyLoss(ignore_index=train_dataset_resnet.vocab.stoi["<pad>"])
+for name, head_model in [("Full", model), ("Adaptive", model_adaptive)]:
+  step_time = benchmark_train_step(head_model, train_loader_resnet, criterion, device, attention=True)
+  bleu = calc_bleu(total_loader_resnet, head_model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=False)
+  print(f"{name} softmax - {step_time*1000:.1f} ms/step - BLEU-4 = {bleu[3]:.4f}")
+
+"""## *Render attention overlays*"""
+
+render_attention_dataset(model, test_loader_resnet, test_dataset_resnet, device, "attention_renders", num_batches=10)
+
+"""## *Fine-tune `layer4` from cached activations*
+ResNet-50 runs once per image up to `layer3` (stored in float16, about 400KB per image); `layer4` and the decoder are fine-tuned from the cache.
+"""
+
+encoder_resnet = EncoderResnet().to(device).eval()
+resnet_cache = build_feature_cache(encoder_resnet.encode_prefix, train_dataset_resnet, transform_Resnet_Test, "resnet_layer3.npy", device)
+del encoder_resnet
+cached_loader_resnet, _ = get_cached_loader(train_dataset_resnet, resnet_cache, resumable=True)
+losses_cached_Attention = train_Attention(cached_loader_resnet, train_dataset_resnet, Attention_hyperparam, device, model_file="/Attention_layer4_ckpt.pth", train_CNN=True, cached_features=True)
+"""# **Bulk Captioning**
+
+## *Near-duplicate images*
+Crawled galleries and video frames contain many identical or near-identical images. Images are grouped by perceptual hash and only one representative per group is encoded and decoded; its caption is copied to the rest of the group.
+
+*   `perceptual_hashes` - 64-bit DCT hashes, computed for the whole batch with one matrix product.
+*   `group_near_duplicates` - Groups every hash with the first representative within `threshold` bits, so closeness does not chain across a group (e.g. the frames of a slow pan). The hash is split into `threshold + 1` bands, so any two matching hashes agree exactly on at least one band and only images sharing a band bucket are compared.
+*   `caption_deduplicated` - Captions `paths`, returns a caption per path and the number of encodes saved.
+"""
+
+def dct_matrix(size):
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+def perceptual_hashes(images, hash_size=8, highfreq_factor=4):
+    size = hash_size * highfreq_factor
+    pixels = np.stack([np.asarray(img.convert("L").resize((size, size), Image.BILINEAR), dtype=np.float32) for img in images])
+    dct = dct_matrix(size)
+    coeffs = dct @ pixels @ dct.T                                  #(num_images,size,size)
+    low = coeffs[:, :hash_size, :hash_size].reshape(len(images), -1)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming_distances(query, hashes):
+    diff = np.bitwise_xor(hashes, query).astype(np.uint64)
+    return POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def group_near_duplicates(hashes, threshold=4):
+    if not 0 <= threshold < 64:
+        raise ValueError(f"threshold must be in [0, 64), got {threshold}")
+    # threshold + 1 disjoint bands: hashes within threshold bits agree on at least one band
+    num_bands = threshold + 1
+    starts = [band * 64 // num_bands for band in range(num_bands + 1)]
+    keys, buckets = [], []
+    for band in range(num_bands):
+        shift = np.uint64(starts[band])
+        mask = np.uint64((1 << (starts[band + 1] - starts[band])) - 1)
+        band_keys = ((hashes >> shift) & mask).tolist()
+        band_buckets = {}
+        for idx, key in enumerate(band_keys):
+            band_buckets.setdefault(key, []).append(idx)
+        keys.append(band_keys)
+        buckets.append(band_buckets)
+
+    # every unassigned hash becomes a representative and takes the unassigned hashes close to it
+    assigned = np.zeros(len(hashes), dtype=bool)
+    groups = []
+    for idx in range(len(hashes)):
+        if assigned[idx]:
+            continue
+        candidates = {other for band in range(num_bands) for other in buckets[band][keys[band][idx]]}
+        candidates = np.array(sorted(other for other in candidates if not assigned[other]))
+        members = candidates[hamming_distances(hashes[idx], hashes[candidates]) <= threshold]
+        assigned[members] = True
+        groups.append(members.tolist())
+    return groups
+
+def caption_deduplicated(model, device, vocabulary, paths, transform, attention=False, threshold=4, batch_size=256):
+    model.eval()
+    start = time.time()
+
+    hashes = []
+    for i in range(0, len(paths), batch_size):
+        images = [Image.open(path).convert("RGB") for path in paths[i:i + batch_size]]
+        hashes.append(perceptual_hashes(images))
+    hashes = np.concatenate(hashes)
+    groups = group_near_duplicates(hashes, threshold)
+    # every image gets the caption of a representative within threshold bits of it
+    assert all((hamming_distances(hashes[group[0]], hashes[group]) <= threshold).all() for group in groups)
+
+    captions = {}
+    with torch.no_grad():
+        for group in tqdm(groups, leave=True, position=0):
+            img = Image.open(paths[group[0]]).convert("RGB")
+            caption = model.caption_image(transform(img).unsqueeze(0).to(device), vocabulary)
+            if attention:
+                caption = caption[0]
+            for idx in group:
+                captions[paths[idx]] = caption
+
+    stats = {
+        "images": len(paths),
+        "groups": len(groups),
+        "encodes_saved": len(paths) - len(groups),
+        "seconds": time.time() - start
+    }
+    print(f"Captioned {stats['images']} images with {stats['groups']} encodes ({stats['encodes_saved']} saved)")
+    model.train()
+    return captions, stats
+
+"""## *Caption a folder without duplicates*"""
+
+bulk_paths = [os.path.join(path_examples, image_path) for image_path in sorted(os.listdir(path_examples))]
+bulk_captions, bulk_stats = caption_deduplicated(model, device, train_dataset_resnet.vocab, bulk_paths, transform_Resnet_Test, attention=True)
+
+"""# **Caption Retrieval**
+Low-latency alternative to the LSTM decoders: the pooled encoder features of the training images are indexed with their captions, and a query image gets the consensus caption of its nearest neighbours.
+
+*   **Features** - `EncoderResnet` mean over the 49 regions (Model 2) or Inception before `fc` (Model 1), L2-normalized and stored as float16.
+*   **Coarse quantizer** - With `num_lists` the index is partitioned by spherical k-means and a query only scans the `num_probe` closest lists (IVF).
+*   **Consensus** - Among the captions of the `k` neighbours, returns the one with the highest n-gram overlap with the others.
+
+## *Retrieval Index*
+"""
+
+def pooled_features(model, images, attention=False):
+    if attention:
+        return model.encoder(images).mean(dim=1)       #(batch_size,2048)
+    return model.encoderCNN.pool_features(images)      #(batch_size,2048)
+
+def spherical_kmeans(x, num_lists, iters=10):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_lists]].clone()
+    for _ in range(iters):
+        assign = (x @ centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=num_lists)
+        centroids = torch.where((counts > 0).unsqueeze(1), f.normalize(sums, dim=1), centroids)
+    return centroids, (x @ centroids.T).argmax(dim=1)
+
+def ngram_counts(tokens, n=2):
+    grams = collections.Counter(tokens)
+    grams.update(zip(tokens, tokens[1:]))
+    return grams
+
+def consensus_caption(candidates):
+    grams = [ngram_counts(c) for c in candidates]
+    sizes = [sum(g.values()) for g in grams]
+
+    def agreement(i):
+        return sum(2 * sum((grams[i] & grams[j]).values()) / max(1, sizes[i] + sizes[j]) for j in range(len(grams)) if j != i)
+
+    return candidates[max(range(len(candidates)), key=agreement)]
+
+class CaptionRetrievalIndex:
+    def __init__(self, features, ids, captions, centroids=None, lists=None):
+        self.features = features.half()                   #(num_images,feature_dim), L2-normalized
+        self.ids = ids
+        self.captions = captions                          # tokenized captions of each image
+        self.centroids = centroids
+        self.lists = lists
+        self.matrix = None
+        if lists is not None:
+            self.order = lists.argsort()
+            self.offsets = torch.cat((torch.zeros(1, dtype=torch.long), torch.bincount(lists, minlength=len(centroids)).cumsum(0)))
+
+    def save(self, filename):
+        torch.save({"features": self.features, "ids": self.ids, "captions": self.captions, "centroids": self.centroids, "lists": self.lists}, filename)
+
+    @staticmethod
+    def load(filename):
+        return CaptionRetrievalIndex(**torch.load(filename))
+
+    def to(self, device):
+        # float16 matmuls on the GPU, float32 on the CPU where half precision is slow
+        dtype = torch.float16 if device.type == "cuda" else torch.float32
+        self.matrix = self.features.to(device=device, dtype=dtype)
+        if self.centroids is not None:
+            self.centroid_matrix = self.centroids.to(device=device, dtype=dtype)
+            self.order = self.order.to(device)
+            self.list_matrix = self.matrix[self.order]     # every list is a contiguous block of rows
+        return self
+
+    def search(self, queries, k=5, num_probe=8, exclude_above=None):
+        if self.matrix is None:
+            self.to(queries.device)
+        queries = f.normalize(queries.float(), dim=1).to(self.matrix.dtype)
+
+        if self.centroids is None:
+            scores = queries @ self.matrix.T               #(num_queries,num_images)
+            if exclude_above is not None:
+                scores = scores.masked_fill(scores >= exclude_above, -2)
+            return scores.topk(k, dim=1).indices.cpu()
+
+        # one matrix product per probed list for all the queries probing it, lists that are not probed stay -inf
+        probes = (queries @ self.centroid_matrix.T).topk(min(num_probe, len(self.centroids)), dim=1).indices
+        probed = torch.zeros(len(queries), len(self.centroids), dtype=torch.bool, device=queries.device).scatter_(1, probes, True)
+        scores = torch.full((len(queries), len(self.order)), -math.inf, dtype=queries.dtype, device=queries.device)
+        offsets = self.offsets.tolist()
+        for l in probed.any(dim=0).nonzero().flatten().tolist():
+            rows = probed[:, l].nonzero().flatten()
+            scores[rows, offsets[l]:offsets[l+1]] = queries[rows] @ self.list_matrix[offsets[l]:offsets[l+1]].T
+        if exclude_above is not None:
+            scores = scores.masked_fill((scores >= exclude_above) & (scores > -math.inf), -2)
+
+        top = scores.topk(min(k, len(self.order)), dim=1)
+        neighbours = self.order[top.indices].cpu()
+        found = (top.values > -math.inf).cpu()
+        return [rows[mask] for rows, mask in zip(neighbours, found)]
+
+def build_retrieval_index(model, dataset, transform, device, attention=False, num_lists=None, batch_size=64, num_workers=2):
+    model.eval()
+    images = Flickr8kImages(dataset, transform=transform)
+    loader = DataLoader(images, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=True)
+
+    features = []
+    with torch.no_grad():
+        for imgs, _ in tqdm(loader, total=len(loader), leave=True, position=0):
+            features.append(f.normalize(pooled_features(model, imgs.to(device), attention).float(), dim=1).cpu())
+    features = torch.cat(features)
+
+    captions = {img_id: [] for img_id in images.ids}
+    for img_id, caption in zip(dataset.imgs, dataset.captions):
+        captions[img_id].append(dataset.vocab.tokenizer_eng(caption))
+
+    centroids, lists = spherical_kmeans(features, num_lists) if num_lists else (None, None)
+    model.train()
+    return CaptionRetrievalIndex(features, images.ids, [captions[img_id] for img_id in images.ids], centroids, lists)
+
+"""## *Retrieval Captioner*
+Same `caption_image` interface as the models, so it can be evaluated with `calc_bleu(..., attention=False)`.
+*   `exclude_above` - Ignores neighbours at least this similar to the query (the query image itself when it is in the index).
+"""
+
+class RetrievalCaptioner(nn.Module):
+    def __init__(self, model, index, attention=False, k=5, num_probe=8, exclude_above=None):
+        super().__init__()
+        self.model = model
+        self.index = index
+        self.attention = attention
+        self.k = k
+        self.num_probe = num_probe
+        self.exclude_above = exclude_above
+
+    def caption_batch(self, images):
+        with torch.no_grad():
+            queries = pooled_features(self.model, images, self.attention)
+        neighbours = self.index.search(queries, self.k, self.num_probe, self.exclude_above)
+        return [consensus_caption([c for idx in rows.tolist() for c in self.index.captions[idx]]) for rows in neighbours]
+
+    def caption_image(self, image, vocabulary, max_length=50):
+        return self.caption_batch(image)[0][:max_length] + ["<eos>"]
+
+"""## *Retrieval vs decoder*
+Every split currently contains all the images, so neighbours identical to the query are excluded to keep the BLEU comparison fair.
+"""
+
+retrieval_index = build_retrieval_index(model, train_dataset_resnet, transform_Resnet_Test, device, attention=True, num_lists=64)
+retrieval_index.save("retrieval_index.pth")
+retrieval_model = RetrievalCaptioner(model, retrieval_index, attention=True, k=5, exclude_above=0.999)
+
+print(calc_bleu(total_loader_resnet, retrieval_model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=False, num_batches=10, multiple_ref=True))
+print(calc_bleu(total_loader_resnet, model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=True))
+
+# latency per image of the index search alone and of caption_batch (encoder, search and consensus)
+retrieval_imgs = next(iter(test_loader_resnet))[0].to(device)
+with torch.no_grad():
+    retrieval_queries = pooled_features(model.eval(), retrieval_imgs, attention=True)
+start = time.time()
+retrieval_index.search(retrieval_queries, k=5, exclude_above=0.999)
+search_ms = (time.time() - start) / len(retrieval_imgs) * 1000
+start = time.time()
+retrieval_model.caption_batch(retrieval_imgs)
+caption_ms = (time.time() - start) / len(retrieval_imgs) * 1000
+model.train()
+print(f"search {search_ms:.3f} ms/image - caption_batch {caption_ms:.3f} ms/image")
+
+"""# **Ensemble Captioning**
+Captions every image with Model 1 and Model 2 and keeps the caption with the highest length-normalized log-probability under the model that produced it, or with `rerank=True` the caption with the highest sum of both models' `score_captions`.
+Each JPEG is decoded once and both the 299x299 Inception tensor and the 224x224 ResNet tensor are made from the same decoded image; the two models then run concurrently in two threads.
+
+*   `EnsembleImages` - Images of a folder (or list of paths) with one tensor per transform.
+*   `caption_ensemble` - Returns the chosen caption and both candidates for every image.
+*   `benchmark_ensemble` - Images/sec of Model 2 alone and of the ensemble on the same images.
+"""
+
+class EnsembleImages(Dataset):
+    def __init__(self, paths, transforms):
+        self.paths = paths
+        self.transforms = transforms
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        img = Image.open(self.paths[index]).convert("RGB")
+        return tuple(transform(img) for transform in self.transforms), self.paths[index]
+
+def get_ensemble_loader(paths, batch_size=32, num_workers=2, pin_memory=True):
+    dataset = EnsembleImages(paths, (create_transform(split='test', model=1), create_transform(split='test', model=2)))
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=pin_memory)
+
+def normalized_logprob(caption, logprob):
+    # caption holds only the predicted tokens, each contributed one term to logprob
+    return logprob / max(1, len(caption))
+
+def caption_ensemble(model_lstm, model_attention, loader, vocabulary, device, max_length=50, rerank=False):
+    model_lstm.eval()
+    model_attention.eval()
+    results = []
+
+    def caption_lstm(img):
+        caption, logprob = model_lstm.caption_image(img.unsqueeze(0), vocabulary, max_length, return_logprob=True)
+        # a leading <sos> is predicted but not scored (see CNNtoRNN.caption_image)
+        if caption[:1] == ["<sos>"]:
+            caption = caption[1:]
+        return caption, logprob
+
+    def caption_attention(img):
+        with torch.no_grad():
+            caption, _, logprob = model_attention.caption_image(img.unsqueeze(0), vocabulary, max_length, return_logprob=True)
+        # the leading <sos> is the decoder input, not a scored token
+        return caption[1:], logprob
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for (imgs_inception, imgs_resnet), paths in tqdm(loader, total=len(loader), leave=True, position=0):
+            imgs_inception = imgs_inception.to(device, non_blocking=True)
+            imgs_resnet = imgs_resnet.to(device, non_blocking=True)
+            for j, path in enumerate(paths):
+                lstm = pool.submit(caption_lstm, imgs_inception[j])
+                attention = pool.submit(caption_attention, imgs_resnet[j])
+                candidates = {"lstm": lstm.result(), "attention": attention.result()}
+                if rerank:
+                    captions = [[candidates[name][0] for name in candidates]]
+                    scores = model_lstm.score_captions(imgs_inception[j:j+1], captions, vocabulary)[0] + model_attention.score_captions(imgs_resnet[j:j+1], captions, vocabulary)[0]
+                    best = list(candidates)[scores.argmax().item()]
+                else:
+                    best = max(candidates, key=lambda name: normalized_logprob(*candidates[name]))
+                results.append({"path": path, "caption": candidates[best][0], "model": best, "candidates": candidates})
+
+    model_lstm.train()
+    model_attention.train()
+    return results
+
+def benchmark_ensemble(model_lstm, model_attention, paths, vocabulary, device, batch_size=32, num_workers=2):
+    single_loader = DataLoader(EnsembleImages(paths, (create_transform(split='test', model=2),)), batch_size=batch_size, num_workers=num_workers, shuffle=False)
+    model_attention.eval()
+    start = time.time()
+    with torch.no_grad():
+        for (imgs,), _ in single_loader:
+            for img in imgs.to(device):
+                model_attention.caption_image(img.unsqueeze(0), vocabulary)
+    single = len(paths) / (time.time() - start)
+    model_attention.train()
+
+    start = time.time()
+    caption_ensemble(model_lstm, model_attention, get_ensemble_loader(paths, batch_size, num_workers), vocabulary, device)
+    ensemble = len(paths) / (time.time() - start)
+
+    print(f"Model 2 - {single:.1f} images/sec, Ensemble - {ensemble:.1f} images/sec ({100 * (single / ensemble - 1):.0f}% overhead)")
+    return single, ensemble
+
+"""## *Caption with both models*"""
+
+LSTM_hyperparam = load_hyperparams(path_checkpoints+"/LSTM_ckpt.pth", device)
+model_lstm = CNNtoRNN(LSTM_hyperparam.embed_size, LSTM_hyperparam.hidden_size, LSTM_hyperparam.vocab_size, LSTM_hyperparam.num_layers).to(device)
+load_checkpoint(path_checkpoints+"/LSTM_ckpt.pth", model_lstm, optim.Adam(model_lstm.parameters()), device)
+
+ensemble_results = caption_ensemble(model_lstm, model, get_ensemble_loader(bulk_paths), train_dataset_resnet.vocab, device)
+benchmark_ensemble(model_lstm, model, bulk_paths, train_dataset_resnet.vocab, device)
+
+"""## *Score candidate captions*
+Scores the captions retrieved for the example images under Model 2 on CPU, e.g. to rerank retrieval candidates.
+"""
+
+example_imgs = torch.stack([transform_Resnet_Test(Image.open(path).convert("RGB")) for path in bulk_paths]).to(device)
+example_candidates = [[c for idx in rows.tolist() for c in retrieval_index.captions[idx]] for rows in retrieval_index.search(pooled_features(model, example_imgs, attention=True), k=20)]
+model.cpu()
+start = time.time()
+example_scores = model.score_captions(example_imgs.cpu(), example_candidates, train_dataset_resnet.vocab)
+print(f"CPU: {sum(len(c) for c in example_candidates) / (time.time() - start):.0f} candidates/sec")
+model.to(device)
+
+"""# **Hyperparameter Sweep**
+Trains a grid of `Hyperparameters` in one process on features cached once, so every configuration only trains its decoder and all of them are fed from the same batch stream.
+*   Model 1 - Cached Inception pool features, every configuration trains its own `fc` (`PooledHead`) and `DecoderRNN`.
+*   Model 2 - Cached ResNet encoder output `(49,2048)`, every configuration trains its own `DecoderAttention`.
+
+## *Sweep Definitions*
+*   `hyperparameter_grid` - Copies of `base` for every combination of the given values, e.g. `decoder_dim=[256,512]`.
+*   `PooledHead` - Trainable part of `EncoderCNN` on cached pool features.
+*   `CachedEncoder` - Encoder of Model 2 when the loader already yields its output.
+"""
+
+def hyperparameter_grid(base, **values):
+    names = list(values)
+    configs = []
+    for combination in itertools.product(*(values[name] for name in names)):
+        hyper = copy.copy(base)
+        for name, value in zip(names, combination):
+            setattr(hyper, name, value)
+        configs.append(hyper)
+    return configs
+
+class PooledHead(nn.Module):
+    def __init__(self, embed_size, in_features=2048):
+        super(PooledHead, self).__init__()
+        self.fc = nn.Linear(in_features, embed_size)
+        self.relu = nn.ReLU()
+        self.dropout = nn.Dropout(0.5)
+
+    def forward(self, pooled):
+        # same as EncoderCNN.forward_cached, with its own fc
+        features = self.fc(f.dropout(pooled.float(), p=0.5, training=self.training))
+        return self.dropout(self.relu(features))
+
+class CachedEncoder(nn.Module):
+    def forward(self, features):
+        return features.float()
+
+def sweep_model(hyper, dataset, device, attention=False):
+    token_counts = dataset.vocab.token_counts() if hyper.output_head == 'adaptive' else None
+    if attention:
+        return EncoderDecoder(hyper.embed_size, hyper.vocab_size, hyper.attention_dim, hyper.encoder_dim, hyper.decoder_dim, token_counts=token_counts, cutoffs=hyper.cutoffs, encoder=CachedEncoder()).to(device)
+    return CNNtoRNN(hyper.embed_size, hyper.hidden_size, hyper.vocab_size, hyper.num_layers, token_counts=token_counts, cutoffs=hyper.cutoffs, encoder=PooledHead(hyper.embed_size)).to(device)
+
+"""## *Sweep Runner*
+*   `configs` - List of `Hyperparameters`, each is trained for its own `num_epochs`.
+*   `train_loader` - Loader from `get_cached_loader`, one pass per epoch is shared by all configurations.
+*   `eval_loader`, `eval_dataset` - Cached loader and dataset for `calc_bleu` after every epoch (`None` to skip).
+*   `bleu_batches` - Number of `eval_loader` batches for `calc_bleu`.
+*   `log_file` - If set then the results are written to this json file after every epoch.
+"""
+
+def run_sweep(configs, train_loader, dataset, device, attention=False, eval_loader=None, eval_dataset=None, bleu_batches=10, log_file=None):
+    models = [sweep_model(hyper, dataset, device, attention) for hyper in configs]
+    optimizers = [optim.Adam(model.parameters(), lr=hyper.learning_rate) for model, hyper in zip(models, configs)]
+    criterion = nn.CrossEntropyLoss(ignore_index=dataset.vocab.stoi["<pad>"])
+    results = [{"config": vars(hyper).copy(), "losses": [], "bleu": []} for hyper in configs]
+
+    for epoch in range(1, max(hyper.num_epochs for hyper in configs) + 1):
+        active = [i for i, hyper in enumerate(configs) if epoch <= hyper.num_epochs]
+        totals = [0.0] * len(configs)
+        if hasattr(train_loader.dataset, "set_epoch"):
+            train_loader.dataset.set_epoch(epoch)
+
+        for imgs, captions, _ in tqdm(train_loader, total=len(train_loader), leave=True, position=0):
+            imgs = imgs.to(device).float()
+            captions = captions.to(device)
+
+            for i in active:
+                loss = caption_loss(models[i], imgs, captions, criterion, attention=attention, chunk_size=configs[i].loss_chunk_size)
+                optimizers[i].zero_grad()
+                loss.backward()
+                optimizers[i].step()
+                totals[i] += loss.detach()               # no sync per step
+
+        for i in active:
+            results[i]["losses"].append(float(totals[i]) / len(train_loader))
+            if eval_loader is not None:
+                results[i]["bleu"].append(calc_bleu(eval_loader, models[i], eval_dataset, device, path_images, path_captions, None, attention=attention, num_batches=bleu_batches))
+            print(f"Epoch {epoch} - Config {i} - Loss = {results[i]['losses'][-1]}" + (f" - BLEU-4 = {results[i]['bleu'][-1][3]}" if eval_loader is not None else ""))
+
+        if log_file is not None:
+            with open(log_file, "w") as file:
+                json.dump(results, file, indent=2)
+    return models, results
+
+"""## *Sweep Model 2 decoders*
+Caches the full ResNet encoder output of all images once and trains every decoder configuration on it.
+"""
+
+encoder_resnet = EncoderResnet().to(device).eval()
+sweep_cache = build_feature_cache(encoder_resnet, total_dataset_resnet, transform_Resnet_Test, "resnet_features.npy", device)
+sweep_loader, _ = get_cached_loader(train_dataset_resnet, sweep_cache, batch_size=64)
+sweep_eval_loader, _ = get_cached_loader(total_dataset_resnet, sweep_cache, shuffle=False)
+
+sweep_configs = hyperparameter_grid(Hyperparameters(embed_size=300, vocab_size=len(train_dataset_resnet.vocab), learning_rate=3e-4, num_epochs=5), attention_dim=[128, 256], decoder_dim=[256, 512], learning_rate=[1e-4, 3e-4, 1e-3])
+sweep_models, sweep_results = run_sweep(sweep_configs, sweep_loader, train_dataset_resnet, device, attention=True, eval_loader=sweep_eval_loader, eval_dataset=total_dataset_resnet, log_file="sweep_attention.json")
+
+best_config = max(range(len(sweep_configs)), key=lambda i: sweep_results[i]["bleu"][-1][3])
+print(sweep_results[best_config]["config"], sweep_results[best_config]["bleu"][-1])
+
+"""## *Sweep Model 1 decoders*"""
+
+encoder_inception = EncoderCNN(LSTM_hyperparam.embed_size).to(device).eval()
+sweep_cache_inception = build_feature_cache(encoder_inception.pool_features, total_dataset_inception, transform_Inception_Test, "inception_pool_total.npy", device)
+del encoder_inception
+sweep_loader_inception, _ = get_cached_loader(train_dataset_inception, sweep_cache_inception, batch_size=64)
+sweep_eval_loader_inception, _ = get_cached_loader(total_dataset_inception, sweep_cache_inception, shuffle=False)
+
+sweep_configs_LSTM = hyperparameter_grid(Hyperparameters(embed_size=256, vocab_size=len(train_dataset_inception.vocab), learning_rate=3e-4, num_epochs=5), embed_size=[256, 512], hidden_size=[256, 512], learning_rate=[1e-4, 3e-4, 1e-3])
+sweep_models_LSTM, sweep_results_LSTM = run_sweep(sweep_configs_LSTM, sweep_loader_inception, train_dataset_inception, device, eval_loader=sweep_eval_loader_inception, eval_dataset=total_dataset_inception, log_file="sweep_LSTM.json")
+
+"""# **Encoder Distillation**
+Trains a MobileNetV2 student to reproduce the features of the frozen encoder on the training images, so the trained decoders run unchanged on a much cheaper encoder.
+*   Model 2 - The student outputs the `(49,2048)` map of `EncoderResnet`.
+*   Model 1 - The student outputs the 2048 pool features of Inception, the teacher's `fc` is copied into a `PooledHead` on top of it.
+
+## *Student Encoder*
+*   `pooled` - If `True` then the feature map is averaged to one vector per image (Model 1).
+*   `distill_features` - Output in the teacher's feature space, `forward` is the same and is the drop-in encoder.
+"""
+
+class StudentEncoder(nn.Module):
+    def __init__(self, out_channels=2048, grid_size=7, pooled=False):
+        super(StudentEncoder, self).__init__()
+        mobilenet = models.mobilenet_v2(pretrained=True)
+        self.features = mobilenet.features
+        # the teacher features come after a ReLU, so the student's are non-negative too
+        self.project = nn.Sequential(nn.Conv2d(mobilenet.last_channel, out_channels, kernel_size=1), nn.ReLU())
+        self.grid_size = grid_size
+        self.pooled = pooled
+
+    def distill_features(self, images):
+        x = self.project(self.features(images))
+        if self.pooled:
+            return x.mean(dim=(2, 3))                                    #(batch_size,2048)
+        x = f.adaptive_avg_pool2d(x, self.grid_size)                     #(batch_size,2048,7,7)
+        return x.flatten(2).transpose(1, 2)                              #(batch_size,49,2048)
+
+    def forward(self, images):
+        return self.distill_features(images)
+
+def student_encoder_CNN(student, teacher_encoder):
+    # drop-in for EncoderCNN: the student followed by the teacher's fc
+    fc = teacher_encoder.inception.fc
+    head = PooledHead(fc.out_features, fc.in_features)
+    head.fc.load_state_dict(fc.state_dict())
+    return nn.Sequential(student, head)
+
+"""## *Distillation Training*
+*   `teacher_fn` - Frozen teacher features of a batch, e.g. `encoder_resnet` or `encoder_inception.pool_features`.
+*   `transform` - Transform of the training images, the train transform of the teacher's model.
+"""
+
+def distill_encoder(student, teacher_fn, dataset, transform, device, num_epochs=5, learning_rate=1e-3, batch_size=32, num_workers=2, model_file='', save_model=True):
+    loader = DataLoader(Flickr8kImages(dataset, transform=transform), batch_size=batch_size, num_workers=num_workers, shuffle=True, pin_memory=True)
+    optimizer = optim.Adam(student.parameters(), lr=learning_rate)
+    losses = []
+    student.train()
+
+    for epoch in range(1, num_epochs + 1):
+        for imgs, _ in tqdm(loader, total=len(loader), leave=True, position=0):
+            imgs = imgs.to(device)
+            with torch.no_grad():
+                targets = teacher_fn(imgs).float()
+
+            loss = f.mse_loss(student.distill_features(imgs), targets)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        losses.append(loss.item())
+        if save_model:
+            save_checkpoint(training_state(student, optimizer, epoch, losses, None), path_checkpoints+model_file)
+        print(f"Epoch {epoch} - Distillation Loss = {loss.item()}")
+
+    student.eval()
+    return losses
+
+"""### *Benchmark encoder time*
+Mean time in ms of one encoder forward for a batch of `batch_size` images.
+"""
+
+def benchmark_encoder(encoder, device, image_size, batch_size=1, num_steps=20, warmup=3):
+    encoder.eval()
+    images = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    with torch.no_grad():
+        for step in range(warmup + num_steps):
+            if step == warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            encoder(images)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / num_steps * 1000
+
+"""## *Distill Model 2 encoder*
+Trains the student on the map of the encoder from the `Attention_ckpt.pth` checkpoint loaded above (its BatchNorm statistics come from that training) and puts it in front of the same decoder.
+"""
+
+model.eval()
+student_resnet = StudentEncoder().to(device)
+losses_student_resnet = distill_encoder(student_resnet, model.encoder, train_dataset_resnet, transform_Resnet_Train, device, model_file="/Student_resnet_ckpt.pth")
+
+model_student = EncoderDecoder(Attention_hyperparam.embed_size, Attention_hyperparam.vocab_size, Attention_hyperparam.attention_dim, Attention_hyperparam.encoder_dim, Attention_hyperparam.decoder_dim, encoder=student_resnet).to(device)
+model_student.decoder.load_state_dict(model.decoder.state_dict())
+
+time_teacher = benchmark_encoder(model.encoder.cpu(), torch.device("cpu"), 224)
+time_student = benchmark_encoder(student_resnet.cpu(), torch.device("cpu"), 224)
+model.encoder.to(device)
+student_resnet.to(device)
+print(f"CPU encoder: {time_teacher:.1f} ms -> {time_student:.1f} ms ({time_teacher / time_student:.1f}x)")
+
+bleu_teacher = calc_bleu(total_loader_resnet, model, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=False)
+bleu_student = calc_bleu(total_loader_resnet, model_student, total_dataset_resnet, device, path_images, path_captions, transform_Resnet_Test, attention=True, num_batches=10, multiple_ref=False)
+print(f"BLEU-4: {bleu_teacher[3]:.4f} -> {bleu_student[3]:.4f}")
+
+"""## *Distill Model 1 encoder*"""
+
+model_lstm.eval()
+student_inception = StudentEncoder(pooled=True).to(device)
+losses_student_inception = distill_encoder(student_inception, model_lstm.encoderCNN.pool_features, train_dataset_inception, transform_Inception_Train, device, model_file="/Student_inception_ckpt.pth")
+
+model_lstm_student = CNNtoRNN(LSTM_hyperparam.embed_size, LSTM_hyperparam.hidden_size, LSTM_hyperparam.vocab_size, LSTM_hyperparam.num_layers, encoder=student_encoder_CNN(student_inception, model_lstm.encoderCNN)).to(device)
+model_lstm_student.decoderRNN.load_state_dict(model_lstm.decoderRNN.state_dict())
+
+time_teacher = benchmark_encoder(model_lstm.encoderCNN.cpu(), torch.device("cpu"), 299)
+time_student = benchmark_encoder(model_lstm_student.encoderCNN.cpu(), torch.device("cpu"), 299)
+model_lstm.to(device)
+model_lstm_student.to(device)
+print(f"CPU encoder: {time_teacher:.1f} ms -> {time_student:.1f} ms ({time_teacher / time_student:.1f}x)")
+
+bleu_teacher = calc_bleu(total_loader_inception, model_lstm, total_dataset_inception, device, path_images, path_captions, transform_Inception_Test, num_batches=10, multiple_ref=False)
+bleu_student = calc_bleu(total_loader_inception, model_lstm_student, total_dataset_inception, device, path_images, path_captions, transform_Inception_Test, num_batches=10, multiple_ref=False)
+print(f"BLEU-4: {bleu_teacher[3]:.4f} -> {bleu_student[3]:.4f}")